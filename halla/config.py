@@ -1,4 +1,5 @@
 import random
+import numpy
 from numpy import array
 version = '0.6.16'
 __description__      = """
@@ -30,12 +31,15 @@ fdr_function = "level"
 permutation_func = 'gpd'
 q = .1  
 iterations = 1000
+sequential_exceedances = 0 # ecdf: stop permuting after this many exceedances (0 = use all iterations)
 p_adjust_method = "bhy"
 randomization_method = "permutation"  # method to generate error bars 
 sstrStep = "uniform"
 verbose = 'CRITICAL' #"DEBUG","INFO","WARNING","ERROR","CRITICAL"
 descending = "HAllA" 
 Distance = [None, None] # Distance Matrices 
+medoid_cache = [{}, {}] # medoid row of each cluster (tuple of feature indices) per dataset
+representative_cache = [{}, {}] # (representative, variance, loading) per cluster, decomposition and metric
 summary_method = "final"
 output_dir = "./"
 log_input = True
@@ -51,6 +55,15 @@ use_one_null_dist = False
 gp = None
 Nexc = None
 nullsamples = []
+random_state = numpy.random # stream the permutation tests draw from (see stats.set_hypothesis_random_state)
+use_null_cache = False # share null samples between tests with the same marginals
+null_cache = {} # null samples and GPD tails keyed by metric and marginal histograms
+use_level_batch = False # test each level of medoid/none hypotheses in one vectorized pass
+alla_screen = 0.0 # AllA: analytic p-value above which a pair skips the permutation test (0 = off)
+sparse = False # zero-inflated data: nmi/mi/pearson/spearman kernels skip the zero (most frequent level) samples; tables stay dense
+table_format = None # printf-style format of the numbers in the dataset and distance matrix dumps (None = exact)
+gzip_tables = False # write the dataset and distance matrix dumps gzip-compressed (.gz)
+cache_dir = None # directory of parsed datasets keyed by input content and parsing settings (None = off)
 number_of_performed_tests = 0
 min_var = 0.0
 entropy_threshold = 0.0
@@ -73,6 +86,7 @@ meta_alla = None  # results of all-against-all
 meta_out = None  # final output array; some methods (e.g. hypotheses_testing) have multiple outputs piped to both meta_alla and meta_out 
 meta_summary = None  # summary statistics 
 meta_report = None  # summary report 
+association_scores = {}  # similarity score of every tested pair of single features (i, j), read by the report
 aOut = None  # summary output for naive approaches_
 FeatureNames = array([None, None])
 SampleNames = array([None, None])
@@ -93,6 +107,7 @@ def reset_default():
     pvalues = None
     meta_summary = None  # summary statistics 
     meta_report = None  # summary report 
+    association_scores = {}
     original_dataset = array([None, None])
     meta_data_tree = [] 
     meta_hypothesis_tree = None 
@@ -12,6 +12,7 @@ import numpy
 import scipy
 import scipy.cluster
 from scipy.spatial.distance import cdist
+import scipy.sparse
 import scipy.stats
 
 from sklearn.metrics import mutual_info_score, normalized_mutual_info_score, \
@@ -158,6 +159,120 @@ def l2(pData1, pData2):
 def absl2(pData1, pData2):
 	return numpy.abs(l2(pData1, pData2))
 
+#==========================================================================#
+# CONTINGENCY KERNELS FOR CODED DATA
+#==========================================================================#
+# Discretized features are label-encoded once (codes 0..k-1 and their counts)
+# and the information measures are computed from a bincount over the joint
+# codes. Cells are visited in the same (column-major, nonzero only) order as
+# sklearn.metrics.mutual_info_score, so the scores match it bit for bit.
+
+def _encode(pData):
+    """
+    Returns integer codes 0..k-1 for the values of pData and the count of each code
+    """
+    pData = numpy.asarray(pData)
+    if pData.dtype.kind in 'iu' and len(pData) and pData.min() >= 0:
+        # already integer coded: relabel the used codes in sorted order
+        aiCounts = numpy.bincount(pData)
+        abUsed = aiCounts > 0
+        return (numpy.cumsum(abUsed) - 1)[pData], aiCounts[abUsed]
+    aiCodes = numpy.unique(pData, return_inverse=True)[1]
+    return aiCodes, numpy.bincount(aiCodes)
+
+def _entropy(aiCounts):
+    """
+    Entropy (nats) of a labeling from its code counts, as sklearn computes it
+    """
+    if len(aiCounts) == 0:
+        return 1.0
+    pi = aiCounts[aiCounts > 0].astype(numpy.float64)
+    pi_sum = numpy.sum(pi)
+    return -numpy.sum((pi / pi_sum) * (numpy.log(pi) - math.log(pi_sum)))
+
+def _mi_encoded(aiX, aiXCounts, aiY, aiYCounts):
+    """
+    Mutual information (nats) between two labelings given as codes and counts
+    """
+    kx, ky = len(aiXCounts), len(aiYCounts)
+    C = numpy.bincount(aiY * kx + aiX, minlength=kx * ky)
+    aiCells = numpy.flatnonzero(C)
+    nz_val = C[aiCells]
+    fN = float(len(aiX))
+    outer = aiXCounts[aiCells % kx].astype(numpy.int64) * aiYCounts[aiCells // kx].astype(numpy.int64)
+    log_outer = -numpy.log(outer) + math.log(fN) + math.log(fN)
+    contingency_nm = nz_val / fN
+    return (contingency_nm * (numpy.log(nz_val) - math.log(fN)) + contingency_nm * log_outer).sum()
+
+def _mi_tables(C, aiOuter, fN):
+    """
+    Mutual information (nats) of a batch of m joint tables
+
+    C is (m x L): each row is a table of counts flattened column-major, and
+    aiOuter holds the matching products of the row and column marginals,
+    either per table (m x L) or shared by all tables (1 x L).
+    """
+    m = len(C)
+    # move the nonzero cells of each table to the front, keeping their order
+    aiOrder = numpy.argsort(C == 0, axis=1, kind='mergesort')
+    aiRows = numpy.arange(m)[:, numpy.newaxis]
+    C = C[aiRows, aiOrder]
+    aiOuter = aiOuter[0][aiOrder] if len(aiOuter) == 1 else aiOuter[aiRows, aiOrder]
+    aiNonzero = numpy.count_nonzero(C, axis=1)
+    aMI = numpy.zeros(m)
+    # tables with the same number of cells are summed together so numpy's
+    # pairwise summation sees exactly the arrays sklearn would sum
+    for iNonzero in numpy.unique(aiNonzero):
+        aiSel = numpy.flatnonzero(aiNonzero == iNonzero)
+        nz_val = C[aiSel, :iNonzero]
+        log_outer = -numpy.log(aiOuter[aiSel, :iNonzero]) + math.log(fN) + math.log(fN)
+        contingency_nm = nz_val / fN
+        aMI[aiSel] = (contingency_nm * (numpy.log(nz_val) - math.log(fN)) +
+                      contingency_nm * log_outer).sum(axis=1)
+    return aMI
+
+def _fill_background(G, aiCountsI, aiBackI, aiCountsJ, aiBackJ):
+    """
+    Completes joint tables counted over foreground samples only
+
+    G is (|I| x kx x |J| x ky): the tables of feature pairs (i, j) counted
+    from the samples off the background (most frequent) level of both
+    features, so the background row aiBackI[i] and column aiBackJ[j] are
+    still zero. Their cells are the rest of the level counts.
+    """
+    ii = numpy.arange(len(aiBackI))[:, numpy.newaxis]
+    jj = numpy.arange(len(aiBackJ))[numpy.newaxis, :]
+    # x level off its background, y on it
+    G[ii, :, jj, aiBackJ[jj]] = aiCountsI[:, numpy.newaxis, :] - G.sum(axis=3).transpose(0, 2, 1)
+    # x on its background: the rest of every y level, which also fixes the corner
+    G[ii, aiBackI[ii], jj, :] = aiCountsJ[numpy.newaxis, :, :] - (G.sum(axis=1) - G[ii, aiBackI[ii], jj, :])
+    return G
+
+def _sparse_one_hot(aiCodes, aiCounts):
+    """
+    CSR (levels x samples) indicator rows of every feature, padded to the
+    largest number of levels, without the samples on the feature's
+    background (most frequent) level; returns it with the background levels
+    """
+    iF, n = aiCodes.shape
+    k = aiCounts.shape[1]
+    aiBack = aiCounts.argmax(axis=1)
+    aiFeature, aiSample = numpy.nonzero(aiCodes != aiBack[:, numpy.newaxis])
+    pOneHot = scipy.sparse.csr_matrix((numpy.ones(len(aiFeature)), (aiFeature * k + aiCodes[aiFeature, aiSample], aiSample)),
+                                      shape=(iF * k, n))
+    return pOneHot, aiBack
+
+def nmi_encoded(aiX, aiXCounts, fHX, aiY, aiYCounts, fHY):
+    """
+    Normalized mutual information from codes, counts and entropies (see _entropy)
+    of two labelings; the entropies can be computed once per feature
+    """
+    if len(aiXCounts) == len(aiYCounts) and len(aiXCounts) <= 1:
+        # no clustering since the data is not split: a perfect match
+        return 1.0
+    fNormalizer = max(math.sqrt(fHX * fHY), numpy.finfo('float64').eps)
+    return _mi_encoded(aiX, aiXCounts, aiY, aiYCounts) / fNormalizer
+
 def mi(pData1, pData2):
 	"""
 	Static implementation of mutual information, returns bits 
@@ -230,24 +345,12 @@ def nmi(X, Y):
     (3, 3) 0.345592029944
     
     """
-    if  not config.missing_char_category:
-        test = [0 in [a, b] for a,b in zip(X,Y)]
-        new_X= [a for a,b in zip (X,test) if ~b]
-        new_Y= [a for a,b in zip (Y,test) if ~b]
-        #print test
-        #print new_X, new_Y
-    else:
-        new_X = X
-        new_Y = Y
-        #print new_X, new_Y
-    #temp_X = X
-    #for i in range(len(X)):
-    #    if X[i] == 'nan':
-     #       print X[i]    
-    #X = [X[i] for i in range(len(X)) if X[i] != 'nan' and Y[i] != 'nan']
-    #Y = [Y[i] for i in range(len(Y)) if temp_X[i] != 'nan' and Y[i] != 'nan']#Y = [Y[i] for i in range(len(Y)) if temp_X[i] != numpy.nan and Y[i] != numpy.nan]
-    
-    return normalized_mutual_info_score(new_X, new_Y) #return NormalizedMutualInformation(pData1, pData2).get_distance() 
+    # Zero codes (missing values) are scored with the rest of the samples
+    # whether or not missing_char_category is set; the old filter on
+    # ~(0 in [a, b]) never dropped a sample, so neither does this
+    aiX, aiXCounts = _encode(X)
+    aiY, aiYCounts = _encode(Y)
+    return nmi_encoded(aiX, aiXCounts, _entropy(aiXCounts), aiY, aiYCounts, _entropy(aiYCounts))
 
 def ami(pData1, pData2):
     """ 
@@ -360,7 +463,420 @@ def distcorr(X, Y):
     dcor = np.sqrt(dcov2_xy)/np.sqrt(np.sqrt(dcov2_xx) * np.sqrt(dcov2_yy))
     return dcor
 
-    
+#==========================================================================#
+# PERMUTED (BATCHED) SIMILARITY FUNCTIONS
+#==========================================================================#
+# Each function scores X against every permuted copy Y[aiPerm[i]] of Y in one
+# pass, where aiPerm is a (k x n) matrix of permutation indices. They return
+# the same values as k calls of the matching function in c_hash_metric.
+
+def _mi_permuted(aiX, aiXCounts, aiY, aiYCounts, aiPerm):
+    """
+    Mutual information (nats) between the codes aiX and each row of aiY[aiPerm]
+
+    All joint tables are counted with a single bincount offset by the row
+    number; the marginals do not change under permutation.
+    """
+    iK, n = aiPerm.shape
+    kx, ky = len(aiXCounts), len(aiYCounts)
+    if config.sparse:
+        # only the samples off the background level of X are counted
+        iBack = aiXCounts.argmax()
+        aiFore = numpy.flatnonzero(aiX != iBack)
+        aiJoint = aiY[aiPerm[:, aiFore]] * kx + aiX[aiFore][numpy.newaxis, :]
+    else:
+        aiJoint = aiY[aiPerm] * kx + aiX[numpy.newaxis, :]
+    aiJoint += (numpy.arange(iK) * (kx * ky))[:, numpy.newaxis]
+    C = numpy.bincount(aiJoint.ravel(), minlength=iK * kx * ky).reshape(iK, kx * ky)
+    if config.sparse:
+        # the background column of each table is the rest of Y's counts
+        C3 = C.reshape(iK, ky, kx)
+        C3[:, :, iBack] = aiYCounts[numpy.newaxis, :] - C3.sum(axis=2)
+    aiOuter = numpy.outer(aiYCounts, aiXCounts).astype(numpy.int64).reshape(1, kx * ky)
+    return _mi_tables(C, aiOuter, float(n))
+
+def mi_permuted(X, Y, aiPerm):
+    aiX, aiXCounts = _encode(X)
+    aiY, aiYCounts = _encode(Y)
+    return math.log(math.e, 2) * _mi_permuted(aiX, aiXCounts, aiY, aiYCounts, aiPerm)
+
+def nmi_permuted(X, Y, aiPerm):
+    aiX, aiXCounts = _encode(X)
+    aiY, aiYCounts = _encode(Y)
+    if len(aiXCounts) == len(aiYCounts) == 1:
+        return numpy.ones(len(aiPerm))
+    # entropies are fixed under permutation, so only the MI term is per row
+    fNormalizer = max(math.sqrt(_entropy(aiXCounts) * _entropy(aiYCounts)), numpy.finfo('float64').eps)
+    return _mi_permuted(aiX, aiXCounts, aiY, aiYCounts, aiPerm) / fNormalizer
+
+def ami_permuted(X, Y, aiPerm):
+    # the expected-MI correction lives in sklearn, so score row by row
+    Y = array(Y)
+    return array([ami(X, Y[aiPermRow]) for aiPermRow in aiPerm])
+
+def _as_vector(pData):
+    pData = array(pData, dtype=float)
+    if pData.ndim > 1:
+        pData = pData[0]
+    return pData
+
+def _sparse_rankdata(X):
+    """
+    scipy.stats.rankdata of X ranking only its non-zero values: the zeros
+    are one tie block whose average rank follows from their count. The
+    ranks are the same numbers, all exact halves.
+    """
+    abFore = X != 0
+    iZeros = len(X) - numpy.count_nonzero(abFore)
+    aRanks = numpy.empty(len(X))
+    aFore = X[abFore]
+    aRanks[abFore] = scipy.stats.rankdata(aFore) + iZeros * (aFore > 0)
+    aRanks[~abFore] = numpy.count_nonzero(aFore < 0) + (iZeros + 1) / 2.0
+    return aRanks
+
+def _centered_permuted_dot(xc, abFore, yc, aiPerm):
+    """
+    xc . yc[aiPerm[i]] for every permutation i, for centered xc and yc,
+    summed over the samples set in abFore only: xc is one constant on the
+    others, and a constant times the sum of a centered vector is zero
+    """
+    aiFore = numpy.flatnonzero(abFore)
+    fBack = xc[~abFore][0] if len(aiFore) < len(xc) else 0.0
+    return yc[aiPerm[:, aiFore]].dot(xc[aiFore] - fBack)
+
+def pearson_permuted(X, Y, aiPerm):
+    # same operations as scipy.stats.pearsonr, one row per permutation
+    X = _as_vector(X)
+    if config.sparse:
+        # only the samples where X is non-zero are permuted and summed
+        Y = _as_vector(Y)
+        xm = X - X.mean()
+        ym = Y - Y.mean()
+        r_num = _centered_permuted_dot(xm, X != 0, ym, aiPerm)
+        r_den = numpy.sqrt(numpy.sum(xm * xm) * numpy.sum(ym * ym))
+        return numpy.clip(r_num / r_den, -1.0, 1.0)
+    Y = _as_vector(Y)[aiPerm]
+    xm = X - X.mean()
+    ym = Y - Y.mean(axis=1)[:, numpy.newaxis]
+    r_num = numpy.add.reduce(xm * ym, axis=1)
+    r_den = numpy.sqrt(numpy.sum(xm * xm) * numpy.sum(ym * ym, axis=1))
+    return numpy.clip(r_num / r_den, -1.0, 1.0)
+
+def spearman_permuted(X, Y, aiPerm):
+    X = _as_vector(X)
+    Y = _as_vector(Y)
+    if numpy.isnan(X).any() or numpy.isnan(Y).any():
+        # nan_policy='omit' drops different samples for every permutation
+        return array([spearman(X, Y[aiPermRow]) for aiPermRow in aiPerm])
+    if config.sparse:
+        # the zeros of each row are one tie block, and only the samples
+        # where X is non-zero are permuted and summed
+        xc = _sparse_rankdata(X)
+        yc = _sparse_rankdata(Y)
+        xc = xc - xc.mean()
+        yc = yc - yc.mean()
+        fFact = numpy.true_divide(1, len(X) - 1)
+        cxy = _centered_permuted_dot(xc, X != 0, yc, aiPerm) * fFact
+        sx = numpy.sqrt(numpy.dot(xc, xc) * fFact)
+        sy = numpy.sqrt(numpy.dot(yc, yc) * fFact)
+        return numpy.clip(cxy / sy / sx, -1.0, 1.0)
+    # ranks commute with permutation, so rank once and correlate the ranks
+    # the way numpy.corrcoef does inside scipy.stats.spearmanr
+    xc = scipy.stats.rankdata(X)
+    yc = scipy.stats.rankdata(Y)[aiPerm]
+    xc = xc - xc.mean()
+    yc = yc - yc.mean(axis=1)[:, numpy.newaxis]
+    fFact = numpy.true_divide(1, len(X) - 1)
+    cxy = yc.dot(xc) * fFact
+    sx = numpy.sqrt(numpy.dot(xc, xc) * fFact)
+    sy = numpy.sqrt(numpy.einsum('ij,ij->i', yc, yc) * fFact)
+    return numpy.clip(cxy / sy / sx, -1.0, 1.0)
+
+#==========================================================================#
+# LEVEL (STACKED PERMUTED) SIMILARITY FUNCTIONS
+#==========================================================================#
+# Each function takes the representatives of H hypotheses stacked as two
+# (H x n) arrays X and Y and one shared (k x n) permutation matrix aiPerm, and
+# returns the (H x k) scores of X[h] against Y[h][aiPerm[i]], the same values
+# as the matching function in c_hash_metric_permuted row by row. iBlockCells
+# bounds the number of cells held at once.
+
+def _encode_rows(pArray):
+    """
+    Codes of every row of pArray with their counts padded to the largest
+    number of levels, plus the number of levels of each row
+    """
+    aEncoded = [_encode(pRow) for pRow in pArray]
+    aiK = array([len(aiCounts) for _, aiCounts in aEncoded])
+    kmax = max(1, aiK.max()) if len(aiK) else 1
+    aiCounts = numpy.zeros((len(aEncoded), kmax), dtype=numpy.int64)
+    for i, (_, aiRowCounts) in enumerate(aEncoded):
+        aiCounts[i, :len(aiRowCounts)] = aiRowCounts
+    aiCodes = array([aiRowCodes for aiRowCodes, _ in aEncoded]).reshape(len(aEncoded), -1)
+    return aiCodes, aiCounts, aiK
+
+def _mi_level(X, Y, aiPerm, bNormalize, iBlockCells=2 ** 22):
+    """
+    Mutual information (nats), or nmi if bNormalize, of every hypothesis
+    against every permutation
+
+    Codes are padded to the largest number of levels in X and in Y, so all
+    joint tables of a block of hypotheses come from one bincount; padded
+    cells are zero and do not change the order sklearn sums the cells in.
+    """
+    aiX, aiXCounts, aiKX = _encode_rows(X)
+    aiY, aiYCounts, aiKY = _encode_rows(Y)
+    iH = len(aiX)
+    iK, n = aiPerm.shape
+    kx, ky = aiXCounts.shape[1], aiYCounts.shape[1]
+    L = kx * ky
+    aMI = numpy.zeros((iH, iK))
+    iBlock = max(1, iBlockCells // max(1, iK * max(L, n)))
+    if config.sparse:
+        aiXBack = aiXCounts.argmax(axis=1)
+    for iStart in range(0, iH, iBlock):
+        I = numpy.arange(iStart, min(iStart + iBlock, iH))
+        if config.sparse:
+            # only the (hypothesis, sample) cells off the background level of X are counted
+            aiFeature, aiSample = numpy.nonzero(aiX[I] != aiXBack[I][:, numpy.newaxis])
+            aiJoint = aiY[I][aiFeature, aiPerm[:, aiSample]] * kx + aiX[I][aiFeature, aiSample]
+            aiJoint += (aiFeature * iK + numpy.arange(iK)[:, numpy.newaxis]) * L
+        else:
+            aiJoint = aiY[I][:, aiPerm] * kx + aiX[I][:, numpy.newaxis, :]
+            aiJoint += (numpy.arange(len(I) * iK) * L).reshape(len(I), iK, 1)
+        C = numpy.bincount(aiJoint.ravel(), minlength=len(I) * iK * L).reshape(len(I) * iK, L)
+        if config.sparse:
+            # the background column of each table is the rest of Y's counts
+            C4 = C.reshape(len(I), iK, ky, kx)
+            C4[numpy.arange(len(I)), :, :, aiXBack[I]] = aiYCounts[I][:, numpy.newaxis, :] - C4.sum(axis=3)
+        aiOuter = (aiYCounts[I][:, :, numpy.newaxis] * aiXCounts[I][:, numpy.newaxis, :]).reshape(len(I), L)
+        aMI[I] = _mi_tables(C, numpy.repeat(aiOuter, iK, axis=0), float(n)).reshape(len(I), iK)
+    if bNormalize:
+        # entropies are fixed under permutation, so the normalizer is per hypothesis
+        for h in range(iH):
+            if aiKX[h] == aiKY[h] == 1:
+                aMI[h] = 1.0
+            else:
+                aMI[h] /= max(math.sqrt(_entropy(aiXCounts[h, :aiKX[h]]) * _entropy(aiYCounts[h, :aiKY[h]])),
+                              numpy.finfo('float64').eps)
+    return aMI
+
+def nmi_level(X, Y, aiPerm):
+    return _mi_level(X, Y, aiPerm, bNormalize=True)
+
+def mi_level(X, Y, aiPerm):
+    return math.log(math.e, 2) * _mi_level(X, Y, aiPerm, bNormalize=False)
+
+def pearson_level(X, Y, aiPerm, iBlockCells=2 ** 22):
+    X = array(X, dtype=float)
+    Y = array(Y, dtype=float)
+    iK, n = aiPerm.shape
+    if config.sparse:
+        # each hypothesis only permutes its non-zero samples of X
+        return array([pearson_permuted(X[h], Y[h], aiPerm) for h in range(len(X))]).reshape(len(X), iK)
+    S = numpy.zeros((len(X), iK))
+    xm = X - X.mean(axis=1)[:, numpy.newaxis]
+    xss = numpy.sum(xm * xm, axis=1)
+    iBlock = max(1, iBlockCells // max(1, iK * n))
+    for iStart in range(0, len(X), iBlock):
+        I = numpy.arange(iStart, min(iStart + iBlock, len(X)))
+        # one row per (hypothesis, permutation); 2-d row reductions sum
+        # in the same order as the 1-d ones of pearson_permuted
+        ym = Y[I][:, aiPerm].reshape(len(I) * iK, n)
+        ym -= ym.mean(axis=1)[:, numpy.newaxis]
+        r_num = numpy.add.reduce(numpy.repeat(xm[I], iK, axis=0) * ym, axis=1)
+        r_den = numpy.sqrt(numpy.repeat(xss[I], iK) * numpy.sum(ym * ym, axis=1))
+        S[I] = (r_num / r_den).reshape(len(I), iK)
+    return numpy.clip(S, -1.0, 1.0)
+
+def spearman_level(X, Y, aiPerm, iBlockCells=2 ** 22):
+    X = array(X, dtype=float)
+    Y = array(Y, dtype=float)
+    iK, n = aiPerm.shape
+    if config.sparse:
+        # each hypothesis only permutes its non-zero samples of X
+        return array([spearman_permuted(X[h], Y[h], aiPerm) for h in range(len(X))]).reshape(len(X), iK)
+    S = numpy.zeros((len(X), iK))
+    abNan = numpy.isnan(X).any(axis=1) | numpy.isnan(Y).any(axis=1)
+    for h in numpy.flatnonzero(abNan):
+        S[h] = spearman_permuted(X[h], Y[h], aiPerm)
+    aiRows = numpy.flatnonzero(~abNan)
+    # ranks commute with permutation, so rank every row once
+    xc = array([scipy.stats.rankdata(X[h]) for h in aiRows]).reshape(len(aiRows), n)
+    yc = array([scipy.stats.rankdata(Y[h]) for h in aiRows]).reshape(len(aiRows), n)
+    xc -= xc.mean(axis=1)[:, numpy.newaxis]
+    fFact = numpy.true_divide(1, n - 1)
+    sx = numpy.sqrt(numpy.einsum('ij,ij->i', xc, xc) * fFact)
+    iBlock = max(1, iBlockCells // max(1, iK * n))
+    for iStart in range(0, len(aiRows), iBlock):
+        I = numpy.arange(iStart, min(iStart + iBlock, len(aiRows)))
+        ycp = yc[I][:, aiPerm].reshape(len(I) * iK, n)
+        ycp -= ycp.mean(axis=1)[:, numpy.newaxis]
+        cxy = numpy.einsum('ij,ij->i', ycp, numpy.repeat(xc[I], iK, axis=0)) * fFact
+        sy = numpy.sqrt(numpy.einsum('ij,ij->i', ycp, ycp) * fFact)
+        S[aiRows[I]] = numpy.clip(cxy / sy / numpy.repeat(sx[I], iK), -1.0, 1.0).reshape(len(I), iK)
+    return S
+
+#==========================================================================#
+# ALL-PAIRS (MATRIX) SIMILARITY FUNCTIONS
+#==========================================================================#
+# Each function returns the (F x F) matrix of scores between all rows of a
+# discretized dataset, matching pMetric(pArray[i], pArray[j]) for i < j.
+
+def _information_matrix(pArray, bNormalize, iBlockCells=2 ** 22):
+    """
+    All-pairs mutual information (nats), or nmi if bNormalize, between the rows of pArray
+
+    Every feature is one-hot encoded once, padded to the largest number of
+    levels kmax, and the joint tables of a block of feature pairs come from
+    one matrix product. Padded cells are zero, so the nonzero cells of a
+    table keep the order sklearn sums them in. iBlockCells bounds the number
+    of table cells held at once.
+    """
+    iF = len(pArray)
+    n = len(pArray[0]) if iF else 0
+    aEncoded = [_encode(pRow) for pRow in pArray]
+    aiK = array([len(aiCounts) for _, aiCounts in aEncoded])
+    kmax = max(1, aiK.max()) if iF else 1
+    aiCounts = numpy.zeros((iF, kmax), dtype=numpy.int64)
+    for i, (_, aiRowCounts) in enumerate(aEncoded):
+        aiCounts[i, :len(aiRowCounts)] = aiRowCounts
+    aH = array([_entropy(aiRowCounts) for _, aiRowCounts in aEncoded])
+    aiCodes = array([aiRowCodes for aiRowCodes, _ in aEncoded]).reshape(iF, n)
+
+    if config.sparse:
+        pSparseOneHot, aiBack = _sparse_one_hot(aiCodes, aiCounts)
+
+    def _one_hot(I):
+        # (levels x samples) indicator rows of the features in I
+        if config.sparse:
+            return pSparseOneHot[I[0] * kmax:(I[-1] + 1) * kmax]
+        pOneHot = numpy.zeros((len(I) * kmax, n))
+        pOneHot[(numpy.arange(len(I)) * kmax)[:, numpy.newaxis] + aiCodes[I], numpy.arange(n)] = 1.0
+        return pOneHot
+
+    S = numpy.zeros((iF, iF))
+    iBlock = max(1, int(math.sqrt(iBlockCells)) // kmax)
+    for iStart in range(0, iF, iBlock):
+        I = numpy.arange(iStart, min(iStart + iBlock, iF))
+        pOneHotI = _one_hot(I)
+        for jStart in range(iStart, iF, iBlock):
+            J = numpy.arange(jStart, min(jStart + iBlock, iF))
+            G = pOneHotI.dot(_one_hot(J).T)
+            if config.sparse:
+                G = _fill_background(G.toarray().reshape(len(I), kmax, len(J), kmax),
+                                     aiCounts[I], aiBack[I], aiCounts[J], aiBack[J])
+            # (x level of i, y level of j) -> column-major table per pair
+            C = G.reshape(len(I), kmax, len(J), kmax).transpose(0, 2, 3, 1).reshape(len(I) * len(J), kmax * kmax)
+            aiOuter = (aiCounts[J][numpy.newaxis, :, :, numpy.newaxis] *
+                       aiCounts[I][:, numpy.newaxis, numpy.newaxis, :]).reshape(len(I) * len(J), kmax * kmax)
+            aMI = _mi_tables(C, aiOuter, float(n)).reshape(len(I), len(J))
+            if bNormalize:
+                aMI /= numpy.maximum(numpy.sqrt(numpy.outer(aH[I], aH[J])), numpy.finfo('float64').eps)
+                aMI[(aiK[I][:, numpy.newaxis] == aiK[J][numpy.newaxis, :]) & (aiK[I][:, numpy.newaxis] <= 1)] = 1.0
+            S[numpy.ix_(I, J)] = aMI
+    # keep the i < j scores (X = row i, as pdist calls the metric) and mirror them
+    aiUpper = numpy.triu_indices(iF, 1)
+    S[aiUpper[1], aiUpper[0]] = S[aiUpper]
+    return S
+
+def nmi_matrix(pArray):
+    return _information_matrix(pArray, bNormalize=True)
+
+def mi_matrix(pArray):
+    return math.log(math.e, 2) * _information_matrix(pArray, bNormalize=False)
+
+#==========================================================================#
+# CROSS-DATASET (MATRIX) SIMILARITY FUNCTIONS
+#==========================================================================#
+# Each function returns the (F1 x F2) matrix of scores between every row of
+# pArray1 and every row of pArray2, as pMetric(pArray1[i], pArray2[j]).
+
+def _information_cross(pArray1, pArray2, bNormalize, iBlockCells=2 ** 22):
+    """
+    Mutual information (nats), or nmi if bNormalize, between the rows of two
+    datasets, with the one-hot blocks of _information_matrix
+    """
+    S, aiXCounts, aiKX, aiYCounts, aiKY = _information_cross_counts(pArray1, pArray2, iBlockCells)
+    if bNormalize:
+        S = _normalize_information(S, aiXCounts, aiKX, aiYCounts, aiKY)
+    return S
+
+def _information_cross_counts(pArray1, pArray2, iBlockCells=2 ** 22):
+    """
+    Mutual information (nats) between the rows of two datasets, plus the
+    padded level counts and number of levels of the rows of each
+    """
+    aiX, aiXCounts, aiKX = _encode_rows(pArray1)
+    aiY, aiYCounts, aiKY = _encode_rows(pArray2)
+    n = aiX.shape[1]
+    kx, ky = aiXCounts.shape[1], aiYCounts.shape[1]
+
+    if config.sparse:
+        pSparseX, aiXBack = _sparse_one_hot(aiX, aiXCounts)
+        pSparseY, aiYBack = _sparse_one_hot(aiY, aiYCounts)
+
+    def _one_hot(aiCodes, I, k):
+        # (levels x samples) indicator rows of the features in I
+        if config.sparse:
+            return (pSparseX if aiCodes is aiX else pSparseY)[I[0] * k:(I[-1] + 1) * k]
+        pOneHot = numpy.zeros((len(I) * k, n))
+        pOneHot[(numpy.arange(len(I)) * k)[:, numpy.newaxis] + aiCodes[I], numpy.arange(n)] = 1.0
+        return pOneHot
+
+    S = numpy.zeros((len(aiX), len(aiY)))
+    iBlockX = max(1, int(math.sqrt(iBlockCells)) // kx)
+    iBlockY = max(1, int(math.sqrt(iBlockCells)) // ky)
+    for iStart in range(0, len(aiX), iBlockX):
+        I = numpy.arange(iStart, min(iStart + iBlockX, len(aiX)))
+        pOneHotI = _one_hot(aiX, I, kx)
+        for jStart in range(0, len(aiY), iBlockY):
+            J = numpy.arange(jStart, min(jStart + iBlockY, len(aiY)))
+            G = pOneHotI.dot(_one_hot(aiY, J, ky).T)
+            if config.sparse:
+                G = _fill_background(G.toarray().reshape(len(I), kx, len(J), ky),
+                                     aiXCounts[I], aiXBack[I], aiYCounts[J], aiYBack[J])
+            # (x level of i, y level of j) -> column-major table per pair
+            C = G.reshape(len(I), kx, len(J), ky).transpose(0, 2, 3, 1).reshape(len(I) * len(J), ky * kx)
+            aiOuter = (aiYCounts[J][numpy.newaxis, :, :, numpy.newaxis] *
+                       aiXCounts[I][:, numpy.newaxis, numpy.newaxis, :]).reshape(len(I) * len(J), ky * kx)
+            S[numpy.ix_(I, J)] = _mi_tables(C, aiOuter, float(n)).reshape(len(I), len(J))
+    return S, aiXCounts, aiKX, aiYCounts, aiKY
+
+def _normalize_information(S, aiXCounts, aiKX, aiYCounts, aiKY):
+    """
+    nmi from the mutual information S and the level counts of the rows
+    """
+    aHX = array([_entropy(aiXCounts[i, :aiKX[i]]) for i in range(len(aiKX))])
+    aHY = array([_entropy(aiYCounts[j, :aiKY[j]]) for j in range(len(aiKY))])
+    S = S / numpy.maximum(numpy.sqrt(numpy.outer(aHX, aHY)), numpy.finfo('float64').eps)
+    S[(aiKX[:, numpy.newaxis] == aiKY[numpy.newaxis, :]) & (aiKX[:, numpy.newaxis] <= 1)] = 1.0
+    return S
+
+def nmi_cross(pArray1, pArray2):
+    return _information_cross(pArray1, pArray2, bNormalize=True)
+
+def mi_cross(pArray1, pArray2):
+    return math.log(math.e, 2) * _information_cross(pArray1, pArray2, bNormalize=False)
+
+def pearson_cross(pArray1, pArray2):
+    X = array(pArray1, dtype=float)
+    Y = array(pArray2, dtype=float)
+    X = X - X.mean(axis=1)[:, numpy.newaxis]
+    Y = Y - Y.mean(axis=1)[:, numpy.newaxis]
+    X /= numpy.sqrt(numpy.einsum('ij,ij->i', X, X))[:, numpy.newaxis]
+    Y /= numpy.sqrt(numpy.einsum('ij,ij->i', Y, Y))[:, numpy.newaxis]
+    return numpy.clip(X.dot(Y.T), -1.0, 1.0)
+
+def spearman_cross(pArray1, pArray2):
+    # rows with missing values (nan) get nan scores
+    def _ranks(pArray):
+        pArray = array(pArray, dtype=float)
+        # the zero tie block gives the same ranks as ranking every sample
+        _rank = _sparse_rankdata if config.sparse else scipy.stats.rankdata
+        return array([_rank(pRow) if not numpy.isnan(pRow).any() else pRow for pRow in pArray]).reshape(pArray.shape)
+    return pearson_cross(_ranks(pArray1), _ranks(pArray2))
+
 c_hash_metric = {"nmi": nmi,
 				"mi": mi,
 				"l2": l2,
@@ -372,6 +888,31 @@ c_hash_metric = {"nmi": nmi,
                 "dcor":distcorr
 				}
 
+# metrics with an all-pairs kernel; others are computed pair by pair with pdist
+c_hash_metric_matrix = {"nmi": nmi_matrix,
+                        "mi": mi_matrix
+                        }
+
+c_hash_metric_cross = {"nmi": nmi_cross,
+                       "mi": mi_cross,
+                       "pearson": pearson_cross,
+                       "spearman": spearman_cross
+                       }
+
+# metrics with a batched permutation kernel; others fall back to one call per permutation
+c_hash_metric_permuted = {"nmi": nmi_permuted,
+                          "mi": mi_permuted,
+                          "ami": ami_permuted,
+                          "pearson": pearson_permuted,
+                          "spearman": spearman_permuted
+                          }
+
+c_hash_metric_level = {"nmi": nmi_level,
+                       "mi": mi_level,
+                       "pearson": pearson_level,
+                       "spearman": spearman_level
+                       }
+
 # ## Visible and shareable to the outside world 
 
 #==========================================================================#
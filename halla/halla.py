@@ -181,6 +181,12 @@ def parse_arguments (args):
         type=int,
         default=1000,
         help="iterations for nonparametric significance testing (permutation test)\n[default = 1000]")
+    argp.add_argument(
+        "--exceedances", metavar="<10>",
+        dest="sequential_exceedances",
+        type=int,
+        default=0,
+        help="ecdf only: stop a permutation test once this many null scores reach the\nobserved one, or once p is clearly above or below the FDR threshold\n(sequential Besag-Clifford test); 0 runs all iterations\n[default = 0]")
 
     argp.add_argument(
         "-m","--metric",
@@ -234,10 +240,46 @@ def parse_arguments (args):
         dest ="use_one_null_distribution", 
         help="Use one null distribution for permutation test", 
         action="store_true")
+    argp.add_argument(
+        "--null-cache",
+        dest ="use_null_cache", 
+        help="Share permutation null samples between tests whose representatives\nhave the same marginal histograms (nmi, mi, ami)", 
+        action="store_true")
+    argp.add_argument(
+        "--screen", metavar="<0.5>",
+        dest="alla_screen",
+        type=float,
+        default=0.0,
+        help="AllA only: skip the permutation test of pairs whose analytic p-value\n(chi-square of 2N*MI for nmi/mi, t for pearson/spearman) is above\nthis cut-off (at least q); they keep the analytic p-value and still\ncount in the FDR correction. Both are large-sample approximations:\nnmi/mi pairs whose contingency table has an expected cell count\nbelow 5 are never screened, and with few samples the t p-value may\nundercut the permutation p-value\n[default = 0, no screening]")
+    argp.add_argument(
+        "--level-batch",
+        dest ="use_level_batch", 
+        help="Test all hypotheses of a level at once against one shared set of\npermutations (medoid and none decompositions; nmi, mi, pearson, spearman)", 
+        action="store_true")
+    argp.add_argument(
+        "--sparse",
+        dest ="sparse", 
+        help="Zero-inflated data: the nmi and mi kernels count only the samples\noff each feature's most frequent (zero) level, spearman ranks the\nzeros as one tie block, and the pearson and spearman permutation\nkernels skip the samples where the first feature is zero; the input\ntables and permutation matrices stay dense; results are unchanged up to float rounding", 
+        action="store_true")
     argp.add_argument(
         "--header",
         action="store_true",
         help="the input files contain a header line") 
+    argp.add_argument(
+        "--table-format", metavar="<%.6g>",
+        dest="table_format",
+        default=None,
+        help="printf-style format of the numbers in X_dataset.txt, Y_dataset.txt\nand the distance matrices, e.g. %%.6g; much faster to write than\nthe exact default\n[default = None, exact]")
+    argp.add_argument(
+        "--gzip-tables",
+        dest="gzip_tables",
+        help="write X_dataset.txt, Y_dataset.txt and the distance matrices\ngzip-compressed (.gz)",
+        action="store_true")
+    argp.add_argument(
+        "--cache", metavar="<cache_dir>",
+        dest="cache_dir",
+        default=None,
+        help="reuse the parsed and discretized datasets stored in this directory\nby an earlier run on the same input files and settings\n[default = None, no cache]")
     
     argp.add_argument(
         "--nproc", metavar="<1>",
@@ -286,6 +328,7 @@ def set_parameters(args):
     config.q = args.dQ  
     config.entropy_threshold = args.entropy_threshold
     config.permutation_func = args.permutation_func
+    config.sequential_exceedances = args.sequential_exceedances
     
     #config.p_adjust_method = args.strAdjust
     #config.randomization_method = args.strRandomization  # method to generate error bars 
@@ -299,6 +342,13 @@ def set_parameters(args):
     istm = list()  # X and Y are used to store datasets
     config.apply_stop_condition = args.apply_stop_condition
     config.use_one_null_dist = args.use_one_null_distribution
+    config.use_null_cache = args.use_null_cache
+    config.use_level_batch = args.use_level_batch
+    config.alla_screen = args.alla_screen
+    config.cache_dir = args.cache_dir
+    config.table_format = args.table_format
+    config.gzip_tables = args.gzip_tables
+    config.sparse = args.sparse
     #config.strDiscretizing = args.strDiscretizing
     if args.seed == -1:
         config.seed = random.randint(1,10000)
@@ -41,7 +41,7 @@ def resoltion_hclust(data=None, distance_matrix=None,
     else:
         Z = Z = linkage(D, method= linkage_method)
     import scipy.cluster.hierarchy as sch
-    hclust_tree = to_tree(Z) 
+    hclust_tree = hierarchy.leaf_tree(Z) 
     #clusters = cutree_to_get_below_threshold_number_of_features (hclust_tree, t = estimated_num_clust)
     if number_of_estimated_clusters == None:
         number_of_estimated_clusters,_ = hierarchy.predict_best_number_of_clusters(hclust_tree, distance_matrix)
@@ -132,7 +132,7 @@ def main( ):
     print "There are %s clusters" %(len(clusters))
     for i in range(len(clusters)):
         f.write("cluster"+str(i+1)+"\t")
-        features = clusters[i].pre_order(lambda x: x.id)
+        features = hierarchy.get_leaves(clusters[i])
         feature_names = [df_distance.index[val] for val in features]
         for item in feature_names:
             f.write("%s " % item)
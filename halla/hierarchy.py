@@ -30,32 +30,108 @@ from profile import Stats
 sys.setrecursionlimit(20000)
 
 # Multi-threading section
+
+# A pool of worker processes that lives for the whole run (see get_pool)
+_pool = None
+
+def _shared_array(pArray):
+    """
+    Copies a numeric dataset into shared memory; returns the shared buffer
+    with its dtype and shape, or the array itself if it is not numeric
+    """
+    import multiprocessing.sharedctypes
+    pArray = numpy.ascontiguousarray(pArray)
+    if pArray.dtype.kind not in 'biuf':
+        return pArray
+    pShared = multiprocessing.sharedctypes.RawArray('b', pArray.nbytes)
+    numpy.frombuffer(pShared, dtype=pArray.dtype)[:] = pArray.ravel()
+    return pShared, pArray.dtype.str, pArray.shape
+
+def _attach_array(pShared):
+    if isinstance(pShared, numpy.ndarray):
+        return pShared
+    pBuffer, strDtype, aShape = pShared
+    return numpy.frombuffer(pBuffer, dtype=strDtype).reshape(aShape)
+
+# run settings read by multi_pMethod and the stats and distance kernels
+c_astrWorkerConfig = ["similarity_method", "decomposition", "permutation_func", "iterations", "q",
+                      "seed", "FeatureNames", "use_one_null_dist", "use_null_cache",
+                      "sequential_exceedances", "p_adjust_method", "use_level_batch",
+                      "alla_screen", "sparse", "NBIN", "missing_method", "missing_char",
+                      "missing_char_category", "strDiscretizing", "Distance"]
+
+def _init_worker(aShared, dConfig):
+    """
+    Runs once in every worker: attaches to the shared datasets and takes
+    the run settings of the parent process
+    """
+    for strName, pValue in dConfig.items():
+        setattr(config, strName, pValue)
+    config.parsed_dataset = array([None, None])
+    config.parsed_dataset[0], config.parsed_dataset[1] = [_attach_array(pShared) for pShared in aShared]
+
+def get_pool():
+    """
+    Returns the worker pool of this run, starting it on first use with
+    config.parsed_dataset in shared memory. The workers take every run
+    setting the kernels read from c_astrWorkerConfig, so they do not rely
+    on inheriting the parent's config through fork
+    """
+    global _pool
+    if _pool is None:
+        import multiprocessing
+        aShared = [_shared_array(pArray) for pArray in config.parsed_dataset]
+        dConfig = dict((strName, getattr(config, strName)) for strName in c_astrWorkerConfig)
+        _pool = multiprocessing.Pool(config.NPROC, initializer=_init_worker, initargs=(aShared, dConfig))
+    return _pool
+
+def close_pool():
+    """
+    Shuts down the worker pool of this run, if one was started
+    """
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
 def multi_pMethod(args):
     """
-    Runs the pMethod function and returns the results plus the id of the node
+    Runs the pMethod function on the features of one hypothesis and returns
+    the results plus the id of the node
     """
     
-    id, pMethod, dataset1, dataset2 = args
-    dP, similarity, left_first_rep_variance, right_first_rep_variance, 
-    left_loading, right_loading, left_rep, right_rep = pMethod(dataset1, dataset2)
+    id, aIndicies = args
+    X = config.parsed_dataset[0][array(aIndicies[0])]
+    Y = config.parsed_dataset[1][array(aIndicies[1])]
+    dP, similarity, left_first_rep_variance, right_first_rep_variance, \
+    left_loading, right_loading, left_rep, right_rep = _test_features(X, Y, aIndicies)
+
+    return id, dP, similarity
 
-    return id, dP, similarity, left_first_rep_variance, right_first_rep_variance,\
-         left_loading, right_loading, left_rep, right_rep
+def is_level_batch():
+    """
+    True if a level of hypotheses can be tested in one pass by stats.permutation_test_by_level
+    """
+    return config.use_level_batch and pMethod is stats.permutation_test and \
+        config.decomposition in stats.c_level_decomposition and \
+        config.similarity_method in distance.c_hash_metric_level and \
+        not config.use_one_null_dist
 
 def multiprocessing_actor(_actor, current_level_tests, pMethod, dataset1, dataset2):
     """
     Return the results from applying the data to the actor function
     """
-    def _multi_pMethod_args(current_level_tests, pMethod, dataset1, dataset2, ids_to_process):
-        for id in ids_to_process:
-            aIndicies = current_level_tests[id].m_pData
-            aIndiciesMapped = map(array, aIndicies)
-            yield [id, pMethod, dataset1[aIndiciesMapped[0]], dataset2[aIndiciesMapped[1]]]
     
-    if config.NPROC > 1:
-        import multiprocessing
-        pool = multiprocessing.Pool(config.NPROC)
-        
+    if is_level_batch():
+        result = [current_level_tests[id].pvalue for id in xrange(len(current_level_tests))]
+        ids_to_process = [id for id in xrange(len(current_level_tests)) if current_level_tests[id].significance == None]
+        if ids_to_process:
+            for id, (dP, similarity) in zip(ids_to_process,
+                    stats.permutation_test_by_level([current_level_tests[id].m_pData for id in ids_to_process])):
+                result[id] = dP
+                current_level_tests[id].similarity_score = similarity
+    elif config.NPROC > 1:
         # check for tests that already have pvalues as these do not need to be recomputed
         ids_to_process=[]
         result = [0] * len(current_level_tests)
@@ -65,15 +141,13 @@ def multiprocessing_actor(_actor, current_level_tests, pMethod, dataset1, datase
             else:
                 ids_to_process.append(id)
         
-        
-        results_by_id = pool.map(multi_pMethod, _multi_pMethod_args(current_level_tests, 
-            pMethod, dataset1, dataset2, ids_to_process))
-        pool.close()
-        pool.join()
+        # workers hold the datasets, so a task is the node id and its feature indices
+        aTasks = [(id, current_level_tests[id].m_pData) for id in ids_to_process]
+        iChunk = max(1, int(math.ceil(len(aTasks) / (4.0 * config.NPROC))))
+        results_by_id = get_pool().map(multi_pMethod, aTasks, chunksize=iChunk)
        
         # order the results by id and apply results to nodes
-        for id, dP, similarity, left_first_rep_variance, right_first_rep_variance, left_loading,\
-         right_loading, left_rep, right_rep in results_by_id:
+        for id, dP, similarity in results_by_id:
             result[id]=dP
             current_level_tests[id].similarity_score = similarity
     else:
@@ -83,9 +157,23 @@ def multiprocessing_actor(_actor, current_level_tests, pMethod, dataset1, datase
                 result.append(current_level_tests[i].pvalue)
             else: 
                 result.append(_actor(current_level_tests[i]))
+    keep_association_scores(current_level_tests)
 
     return result
 
+def keep_association_scores(apTests):
+    """
+    Keeps the similarity score of the tested singleton hypotheses in
+    config.association_scores: permutation tests score the two features
+    themselves, so the report can read them instead of recomputing them
+    """
+    if pMethod is not stats.permutation_test:
+        return
+    for pTest in apTests:
+        aIndicies = pTest.m_pData
+        if len(aIndicies[0]) == 1 and len(aIndicies[1]) == 1 and pTest.similarity_score is not None:
+            config.association_scores[(aIndicies[0][0], aIndicies[1][0])] = pTest.similarity_score
+
 #==========================================================================#
 # DATA STRUCTURES 
 #==========================================================================#
@@ -121,8 +209,183 @@ class Hypothesis_Node():
         self.significance =  None
         self.rank = None
 
+class Hypothesis_Tree(object):
+    '''
+    Struct-of-arrays store for the coupled hypothesis tree.
+    Each hypothesis is a row: the two clusters are ids into per-dataset
+    tables of leaf indices, children are a contiguous range of rows
+    (child_start, child_count) and test results live in numpy columns.
+    Hypothesis_Tree_Node handles give rows the Hypothesis_Node interface.
+    '''
+    # (column, dtype, value of an empty row)
+    c_columns = [("cluster0", numpy.int32, -1), ("cluster1", numpy.int32, -1),
+                 ("level_number", numpy.int32, 1),
+                 ("left_distance", numpy.float64, numpy.nan), ("right_distance", numpy.float64, numpy.nan),
+                 ("pvalue", numpy.float64, numpy.nan), ("qvalue", numpy.float64, numpy.nan),
+                 ("similarity_score", numpy.float64, numpy.nan), ("rank", numpy.int64, 0),
+                 ("significance", numpy.int8, -1),
+                 ("already_tested", numpy.bool_, False), ("already_passed", numpy.bool_, False),
+                 ("child_start", numpy.int32, 0), ("child_count", numpy.int32, 0),
+                 ("unset", numpy.uint8, 0xff)]
+    # bits of the unset column: optional fields that still hold None
+    c_optional = ["left_distance", "right_distance", "pvalue", "qvalue", "similarity_score", "rank"]
+
+    def __init__(self, iCapacity=1024):
+        self.clusters = [[], []]
+        self.cluster_ids = [{}, {}]
+        self.size = 0
+        self.capacity = iCapacity
+        for strColumn, pType, fill in self.c_columns:
+            setattr(self, strColumn, numpy.full(iCapacity, fill, dtype=pType))
+        self.m_apNodes = {}
+
+    def _reserve(self, iRows):
+        if self.size + iRows <= self.capacity:
+            return
+        iCapacity = max(2 * self.capacity, self.size + iRows)
+        for strColumn, pType, fill in self.c_columns:
+            aColumn = numpy.full(iCapacity, fill, dtype=pType)
+            aColumn[:self.size] = getattr(self, strColumn)[:self.size]
+            setattr(self, strColumn, aColumn)
+        self.capacity = iCapacity
+
+    def cluster_id(self, iDataset, pClusterNode):
+        """
+        Returns the id of a cluster, storing its leaves the first time it is seen
+        """
+        try:
+            key = pClusterNode.id
+        except AttributeError:
+            key = id(pClusterNode)
+        iCluster = self.cluster_ids[iDataset].get(key)
+        if iCluster is None:
+            try:
+                aLeaves = get_leaves(pClusterNode)
+            except:
+                aLeaves = reduce_tree(pClusterNode)
+            iCluster = self.add_cluster(iDataset, aLeaves)
+            self.cluster_ids[iDataset][key] = iCluster
+        return iCluster
+
+    def add_cluster(self, iDataset, aLeaves):
+        self.clusters[iDataset].append(aLeaves)
+        return len(self.clusters[iDataset]) - 1
+
+    def add(self, iCluster0, iCluster1, level_number=1, left_distance=None, right_distance=None):
+        """
+        Appends a hypothesis row and returns its index
+        """
+        self._reserve(1)
+        i = self.size
+        self.size += 1
+        self.cluster0[i] = iCluster0
+        self.cluster1[i] = iCluster1
+        self.level_number[i] = level_number
+        pNode = Hypothesis_Tree_Node(self, i)
+        pNode.left_distance = left_distance
+        pNode.right_distance = right_distance
+        return i
+
+    def set_children(self, iParent, iStart, iStop):
+        self.child_start[iParent] = iStart
+        self.child_count[iParent] = iStop - iStart
+
+    def node(self, i):
+        """
+        Returns the (cached) Hypothesis_Tree_Node handle of row i
+        """
+        pNode = self.m_apNodes.get(i)
+        if pNode is None:
+            pNode = self.m_apNodes[i] = Hypothesis_Tree_Node(self, i)
+        return pNode
+
+    def cluster_size(self, aiRows):
+        """
+        Number of feature pairs covered by each of the given hypotheses
+        """
+        aSize0 = numpy.array([len(aLeaves) for aLeaves in self.clusters[0]], dtype=numpy.int64)
+        aSize1 = numpy.array([len(aLeaves) for aLeaves in self.clusters[1]], dtype=numpy.int64)
+        aiRows = numpy.asarray(aiRows, dtype=numpy.int64)
+        return aSize0[self.cluster0[aiRows]] * aSize1[self.cluster1[aiRows]]
+
+def _tree_column(strColumn):
+    """
+    Property reading and writing one column of the node's Hypothesis_Tree row
+    """
+    if strColumn in Hypothesis_Tree.c_optional:
+        iBit = 1 << Hypothesis_Tree.c_optional.index(strColumn)
+        def fget(self):
+            if self.tree.unset[self.index] & iBit:
+                return None
+            return getattr(self.tree, strColumn)[self.index].item()
+        def fset(self, value):
+            if value is None:
+                self.tree.unset[self.index] |= iBit
+            else:
+                self.tree.unset[self.index] &= ~iBit & 0xff
+                getattr(self.tree, strColumn)[self.index] = value
+    elif strColumn == "significance":
+        def fget(self):
+            iSignificance = self.tree.significance[self.index]
+            return None if iSignificance < 0 else bool(iSignificance)
+        def fset(self, value):
+            self.tree.significance[self.index] = -1 if value is None else int(bool(value))
+    else:
+        def fget(self):
+            return getattr(self.tree, strColumn)[self.index].item()
+        def fset(self, value):
+            getattr(self.tree, strColumn)[self.index] = value
+    return property(fget, fset)
+
+class Hypothesis_Tree_Node(object):
+    '''
+    A row of a Hypothesis_Tree seen through the Hypothesis_Node interface
+    '''
+    __slots__ = ['tree', 'index']
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = index
+
+    def _get_data(self):
+        return [self.tree.clusters[0][self.tree.cluster0[self.index]],
+                self.tree.clusters[1][self.tree.cluster1[self.index]]]
+    def _set_data(self, data):
+        self.tree.cluster0[self.index] = self.tree.add_cluster(0, data[0])
+        self.tree.cluster1[self.index] = self.tree.add_cluster(1, data[1])
+    m_pData = property(_get_data, _set_data)
+
+    @property
+    def m_arrayChildren(self):
+        # a tuple: the children are a row range of the tree, not a list to edit
+        iStart = self.tree.child_start[self.index]
+        return tuple(self.tree.node(i) for i in range(iStart, iStart + self.tree.child_count[self.index]))
+
+    left_distance = _tree_column("left_distance")
+    right_distance = _tree_column("right_distance")
+    pvalue = _tree_column("pvalue")
+    qvalue = _tree_column("qvalue")
+    similarity_score = _tree_column("similarity_score")
+    level_number = _tree_column("level_number")
+    significance = _tree_column("significance")
+    rank = _tree_column("rank")
+    already_passed = _tree_column("already_passed")
+    already_tested = _tree_column("already_tested")
+
+def hypotheses_cluster_size(apNodes):
+    """
+    Number of feature pairs covered by each hypothesis
+    """
+    if apNodes and all(isinstance(pNode, Hypothesis_Tree_Node) for pNode in apNodes):
+        return apNodes[0].tree.cluster_size([pNode.index for pNode in apNodes])
+    return [len(pNode.m_pData[0]) * len(pNode.m_pData[1]) for pNode in apNodes]
+
+def _check_mutable(node):
+    if isinstance(node, Hypothesis_Tree_Node):
+        raise TypeError("the children of a Hypothesis_Tree row are fixed by Hypothesis_Tree.set_children")
+
 def pop(node):
     # pop one of the children, else return none, since this amounts to killing the singleton 
+    _check_mutable(node)
     if node.m_arrayChildren:
         return node.m_arrayChildren.pop()
 
@@ -145,6 +408,7 @@ def is_degenerate(node):
     return (not(node.m_pData) and not(node.m_arrayChildren))            
 
 def add_child(node, data):
+    _check_mutable(node)
     if not isinstance(data, Hypothesis_Node):
         pChild = Hypothesis_Node(data)
     else:
@@ -153,6 +417,7 @@ def add_child(node, data):
     return node 
     
 def add_children(node, aData):
+    _check_mutable(node)
     for item in aData:
         node = add_child(node, item)
     return node 
@@ -288,16 +553,43 @@ def is_tree(pObj):
 def hclust(dataset, labels, dataset_number):
     bTree=True
     linkage_method = 'single'
-    D = pdist(dataset, metric=distance.pDistance) 
+    if config.similarity_method in distance.c_hash_metric_matrix:
+        # all pairs at once, same values as pdist with distance.pDistance
+        S = distance.c_hash_metric_matrix[config.similarity_method](dataset)
+        D = numpy.fabs(1.0 - numpy.fabs(S[numpy.triu_indices(len(dataset), 1)]))
+    else:
+        D = pdist(dataset, metric=distance.pDistance) 
     config.Distance[dataset_number] =  copy.deepcopy(squareform(D))
+    config.medoid_cache[dataset_number] = {}
     if config.diagnostics_plot:
         print "--- plotting heatmap for Dataset", str(dataset_number)," ... "
         Z = plot.heatmap(data_table = dataset , D = D, xlabels_order = [], xlabels = labels, filename= config.output_dir+"/"+"hierarchical_heatmap_"+str(config.similarity_method)+"_" + str(dataset_number), method =linkage_method, dataset_number= None)
     else:
         Z = linkage(D, method= linkage_method)
     import scipy.cluster.hierarchy as sch
-    logger.write_table(data=config.Distance[dataset_number], name=config.output_dir+'/Distance_matrix'+str(dataset_number)+'.tsv', rowheader=config.FeatureNames[dataset_number], colheader=config.FeatureNames[dataset_number])
-    return to_tree(Z) if (bTree and len(dataset)>1) else Z, sch.dendrogram(Z, orientation='right')['leaves'] if len(dataset)>1 else sch.dendrogram(Z)['leaves']
+    logger.write_table(data=config.Distance[dataset_number], name=config.output_dir+'/Distance_matrix'+str(dataset_number)+'.tsv'+(".gz" if config.gzip_tables else ""), rowheader=config.FeatureNames[dataset_number], colheader=config.FeatureNames[dataset_number], fmt=config.table_format)
+    return leaf_tree(Z) if (bTree and len(dataset)>1) else Z, sch.dendrogram(Z, orientation='right')['leaves'] if len(dataset)>1 else sch.dendrogram(Z)['leaves']
+
+def leaf_tree(Z):
+    """
+    to_tree with the leaves of every cluster indexed once from the linkage matrix.
+    Each ClusterNode gets leaf_order, the leaf ids of the whole tree in dendrogram
+    order, and leaf_range, the contiguous slice of it that holds its own leaves,
+    so get_leaves does not walk the tree.
+    """
+    pRoot, apNodes = to_tree(Z, rd=True)
+    n = len(Z) + 1
+    aOrder = leaves_list(Z).tolist()
+    aiStart = [0] * len(apNodes)
+    # clusters are merged bottom-up, so their ranges are set top-down
+    for i in range(len(Z) - 1, -1, -1):
+        pNode = apNodes[n + i]
+        aiStart[pNode.left.id] = aiStart[pNode.id]
+        aiStart[pNode.right.id] = aiStart[pNode.id] + pNode.left.count
+    for pNode in apNodes:
+        pNode.leaf_order = aOrder
+        pNode.leaf_range = slice(aiStart[pNode.id], aiStart[pNode.id] + pNode.count)
+    return pRoot
 
 def dendrogram(Z):
     return scipy.cluster.hierarchy.dendrogram(Z)
@@ -613,8 +905,8 @@ def descending_silhouette_coefficient(cluster, dataset_number):
     #Ref: http://scikit-learn.org/stable/modules/clustering.html#homogeneity-completeness-and-v-measure
     pMe = distance.c_hash_metric[config.similarity_method]
     sub_cluster = truncate_tree([cluster], level=0, skip=1)
-    all_a_clusters = sub_cluster[0].pre_order(lambda x: x.id)
-    all_b_clusters = sub_cluster[1].pre_order(lambda x: x.id)
+    all_a_clusters = get_leaves(sub_cluster[0])
+    all_b_clusters = get_leaves(sub_cluster[1])
     s_all_a = []
     s_all_b = []
     temp_all_a_clusters = []
@@ -657,48 +949,37 @@ def descending_silhouette_coefficient(cluster, dataset_number):
 def silhouette_coefficient(clusters, distance_matrix):
     #====check within class homogeniety
     #Ref: http://scikit-learn.org/stable/auto_examples/cluster/plot_kmeans_silhouette_analysis.html
-    #pMe = distance.c_hash_metric[config.Distance]
-    distance_matrix = pandas.DataFrame(distance_matrix)
+    # Each cluster is scored against its neighbour clusters in the list with
+    # submatrix means of the distance matrix, one row per feature
+    distance_matrix = numpy.asarray(distance_matrix)
     silhouette_scores = []
     if len(clusters) <= 1:
         sys.exit("silhouette method needs at least two clusters!")
+    aLeaves = [get_leaves(cluster) for cluster in clusters]
         
     for i in range(len(clusters)):
-        cluster_a = clusters[i].pre_order(lambda x: x.id)
-        #cluster_b = [val for val in range(len(config.Distance[dataset_number])) if val not in cluster_a]
-        #print cluster_a, cluster_b
+        cluster_a = aLeaves[i]
         if i%2 == 0 and i<len(clusters)-1:
-            next_cluster = clusters[i+1].pre_order(lambda x: x.id)
+            next_cluster = aLeaves[i+1]
         else:
-            next_cluster = clusters[i-1].pre_order(lambda x: x.id)
-        #all_features = [a for a in range(len(distance_matrix))] 
-        #cluster_b = [item for item in all_features if item not in cluster_a]  
+            next_cluster = aLeaves[i-1]
          
         if i%2 != 0 and i> 0:
-            prev_cluster = clusters[i-1].pre_order(lambda x: x.id)
+            prev_cluster = aLeaves[i-1]
         elif i < len((clusters))-1:
-            prev_cluster = clusters[i+1].pre_order(lambda x: x.id)
+            prev_cluster = aLeaves[i+1]
         else: 
-            prev_cluster = clusters[i-1].pre_order(lambda x: x.id)
-        #next_cluster = [clusters[num].pre_order(lambda x: x.id) for num in range(i+1, len(clusters)) if clusters[num].pre_order(lambda x: x.id)>1 ]
-        #prev_cluster = [clusters[num].pre_order(lambda x: x.id) for num in range(0, i-1) if clusters[num].pre_order(lambda x: x.id)>1 and i>0  ]
-        #print next_cluster, cluster_a
-        #silhouette_score.append(silhouette_coefficient(cluster))
-        s_all_a = []
-        for a_feature in cluster_a:
-            if len(cluster_a) ==1:
-                a = 0.0
-            else:
-                temp_a_features = cluster_a[:]#deepcopy(all_a_clusters)
-                #print 'before', temp_a_features
-                temp_a_features.remove(a_feature)
-                a = np.mean([distance_matrix.iloc[i, j] for i,j in product([a_feature], temp_a_features)])            
-            b1 = np.mean([ distance_matrix.iloc[i, j] for i,j in product([a_feature], next_cluster)])
-            b2 = np.mean([ distance_matrix.iloc[i, j] for i,j in product([a_feature], prev_cluster)])
-            b = min(b1,b2)
-            s = (b-a)/max([a,b])
-            #print 's a', s, a, b
-            s_all_a.append(s)
+            prev_cluster = aLeaves[i-1]
+        k = len(cluster_a)
+        if k == 1:
+            a = numpy.zeros(1)
+        else:
+            # mean distance of each feature to the rest of its cluster
+            a = distance_matrix[numpy.ix_(cluster_a, cluster_a)][~numpy.eye(k, dtype=bool)].reshape(k, k-1).mean(axis=1)
+        b1 = distance_matrix[numpy.ix_(cluster_a, next_cluster)].mean(axis=1)
+        b2 = distance_matrix[numpy.ix_(cluster_a, prev_cluster)].mean(axis=1)
+        b = numpy.where(b2 < b1, b2, b1)
+        s_all_a = (b-a)/numpy.where(b > a, b, a)
         silhouette_scores.append(np.mean(s_all_a))
     return silhouette_scores
 
@@ -706,28 +987,27 @@ def get_medoid(features, distance_matrix):
     med = features[0]#max(distance_matrix)
     #print features#, distance_matrix.iloc[features[0]]
     medoid_index = med
-    for i in features:
-        temp_mean = numpy.mean(distance_matrix.iloc[i])
+    for i, temp_mean in zip(features, numpy.asarray(distance_matrix)[features].mean(axis=1)):
         if temp_mean <= med:
             med = temp_mean
             medoid_index = i
     return medoid_index
 def wss_heirarchy(clusters, distance_matrix):
+    distance_matrix = numpy.asarray(distance_matrix)
     wss = numpy.zeros(len(clusters))
     temp_wss = 0.0
     for i in range(len(clusters)):
         if clusters[i].get_count() == 1:
             wss[i] = 0.0
         else:
-            cluster_a = clusters[i].pre_order(lambda x: x.id)
+            cluster_a = get_leaves(clusters[i])
             
             temp_a_features = cluster_a[:]
             medoid_feature = get_medoid(temp_a_features, distance_matrix)#temp_a_features[len(temp_a_features)-1]
             # remove medoid
             temp_a_features.remove(medoid_feature)
             
-            temp_wss = sum([distance_matrix.iloc[i_t,j_t]* distance_matrix.iloc[i_t,j_t] 
-                            for i_t,j_t in product([medoid_feature], temp_a_features)])
+            temp_wss = sum(distance_matrix[medoid_feature, temp_a_features] ** 2)
             wss[i] = temp_wss# * clusters[i].get_count()
     #print wss
     avgWithinSS = np.sum(wss) #[sum(d)/X.shape[0] for d in dist]
@@ -785,7 +1065,10 @@ def predict_best_number_of_clusters(hierarchy_tree, distance_matrix):
     print "The best guess for the number of clusters is: ", best_clust_size
     return best_clust_size, clusters       
 def get_leaves(cluster):
-    return cluster.pre_order(lambda x: x.id)  
+    try:
+        return cluster.leaf_order[cluster.leaf_range]
+    except AttributeError:
+        return cluster.pre_order(lambda x: x.id)
     
 def get_homogenous_clusters_silhouette(cluster, distance_matrix, number_of_estimated_clusters=None, resolution= 'high'):
     n = cluster.get_count()
@@ -839,7 +1122,7 @@ def couple_tree(apClusterNode0, apClusterNode1, dataset1, dataset2, strMethod="u
 
     Returns
     -----------
-    tH : Hypothesis_Node object 
+    tH : Hypothesis_Tree_Node object, the root of a Hypothesis_Tree 
 
     Examples
     ----------------
@@ -853,15 +1136,9 @@ def couple_tree(apClusterNode0, apClusterNode1, dataset1, dataset2, strMethod="u
     max_dist_cluster2 = max (node.dist for node in apClusterNode1)
 
     # Create the root of the coupling tree
+    pTree = Hypothesis_Tree()
     for a, b in itertools.product(apClusterNode0, apClusterNode1):
-        try:
-            data1 = a.pre_order(lambda x: x.id)
-            data2 = b.pre_order(lambda x: x.id)
-        except:
-            data1 = reduce_tree(a)
-            data2 = reduce_tree(b)
-    Hypothesis_Tree_Root = Hypothesis_Node([data1, data2])
-    Hypothesis_Tree_Root.level_number = 0
+        iRoot = pTree.add(pTree.cluster_id(0, a), pTree.cluster_id(1, b), level_number=0)
     # Get the first level homogeneous clusters
     apChildren0 = get_homogenous_clusters_silhouette (apClusterNode0[0], config.Distance[0])
     #cutree_to_get_number_of_features(apClusterNode0[0])
@@ -872,33 +1149,18 @@ def couple_tree(apClusterNode0, apClusterNode1, dataset1, dataset2, strMethod="u
     #print "first cut", [a.pre_order(lambda x: x.id) for a in apChildren0]
     #print "first cut", [a.pre_order(lambda x: x.id) for a in apChildren1]
     
-    childList = []
     L = []    
+    iStart = pTree.size
     for a, b in itertools.product(apChildren0, apChildren1):
-        try:
-            data1 = a.pre_order(lambda x: x.id)
-            data2 = b.pre_order(lambda x: x.id)
-        except:
-            data1 = reduce_tree(a)
-            data2 = reduce_tree(b)
-        tempTree = Hypothesis_Node(data=[data1, data2], left_distance=a.dist, right_distance=b.dist)
-        tempTree.level_number = 1
-        childList.append(tempTree)
-        L.append((tempTree, (a, b)))
-    Hypothesis_Tree_Root = add_children(Hypothesis_Tree_Root, childList)
+        iChild = pTree.add(pTree.cluster_id(0, a), pTree.cluster_id(1, b), level_number=1,
+                           left_distance=a.dist, right_distance=b.dist)
+        L.append((iChild, (a, b)))
+    pTree.set_children(iRoot, iStart, pTree.size)
     #print "child list:", childList
     next_L = []
     level_number = 2
     while L:
-        (pStump, (a, b)) = L.pop(0)
-        #print "child list:", tempNode
-        #continue
-        try:
-            data1 = a.pre_order(lambda x: x.id)
-            data2 = b.pre_order(lambda x: x.id)
-        except:
-            data1 = reduce_tree(a)
-            data2 = reduce_tree(b)        
+        (iStump, (a, b)) = L.pop(0)
         bTauX = _is_stop(a, X, max_dist_cluster1)  # ( _min_tau(X[array(data1)], func) >= x_threshold ) ### parametrize by mean, min, or max
         bTauY = _is_stop(b, Y, max_dist_cluster2)  # ( _min_tau(Y[array(data2)], func) >= y_threshold ) ### parametrize by mean, min, or max
         if bTauX and bTauY :
@@ -928,22 +1190,13 @@ def couple_tree(apClusterNode0, apClusterNode1, dataset1, dataset2, strMethod="u
         else:
             apChildren1 = [b]
 
-        LChild = [(c1, c2) for c1, c2 in itertools.product(apChildren0, apChildren1)] 
-        childList = []
-        while LChild:
-            (a1, b1) = LChild.pop(0)
-            try:
-                data1 = a1.pre_order(lambda x: x.id)
-                data2 = b1.pre_order(lambda x: x.id)
-            except:
-                data1 = reduce_tree(a1)
-                data2 = reduce_tree(b1)
-            
-            tempTree = Hypothesis_Node(data=[data1, data2], left_distance=a1.dist, right_distance=b1.dist)
-            tempTree.level_number = level_number
-            childList.append(tempTree)
-            next_L.append((tempTree, (a1, b1)))
-        pStump = add_children(pStump, childList)
+        # the children of a stump are added together so they form one contiguous range
+        iStart = pTree.size
+        for a1, b1 in itertools.product(apChildren0, apChildren1):
+            iChild = pTree.add(pTree.cluster_id(0, a1), pTree.cluster_id(1, b1), level_number=level_number,
+                               left_distance=a1.dist, right_distance=b1.dist)
+            next_L.append((iChild, (a1, b1)))
+        pTree.set_children(iStump, iStart, pTree.size)
         if not L:
             #print "*****Finished coupling for level: ", level_number
             if next_L:
@@ -953,7 +1206,7 @@ def couple_tree(apClusterNode0, apClusterNode1, dataset1, dataset2, strMethod="u
                 #print "******************len: ",len(L)
     #print "Coupled Hypothesis_Node", reduce_tree_by_la
     #print "Number of levels after coupling", level_number-1
-    return [Hypothesis_Tree_Root]
+    return [pTree.node(iRoot)]
 pHashMethods = {"permutation" : stats.permutation_test,
                         "permutation_test_by_medoid": stats.permutation_test_by_medoid,
                         
@@ -968,6 +1221,17 @@ pHashMethods = {"permutation" : stats.permutation_test,
 
 strMethod = config.randomization_method
 pMethod = pHashMethods[strMethod]
+def _test_features(X, Y, aIndicies):
+    """
+    Runs pMethod on the rows X and Y of the parsed datasets; permutation_test
+    also gets their feature indices so it can reuse what hclust computed
+    """
+    # every hypothesis draws from its own stream, so its p-value does not
+    # depend on which process tests it or in what order
+    stats.set_hypothesis_random_state(aIndicies)
+    if pMethod is stats.permutation_test:
+        return pMethod(X, Y, aIndicies = aIndicies)
+    return pMethod(X, Y)
 def _actor(pNode):
     dataset1 = config.parsed_dataset[0]
     dataset2 = config.parsed_dataset[1]
@@ -980,7 +1244,7 @@ def _actor(pNode):
     aIndiciesMapped = map(array, aIndicies)  # # So we can vectorize over numpy arrays
     X = dataset1[aIndiciesMapped[0]]
     Y = dataset2[aIndiciesMapped[1]]
-    dP, similarity, left_first_rep_variance, right_first_rep_variance, left_loading, right_loading, left_rep, right_rep = pMethod(X, Y)
+    dP, similarity, left_first_rep_variance, right_first_rep_variance, left_loading, right_loading, left_rep, right_rep = _test_features(X, Y, aIndicies)
     pNode.similarity_score = similarity
     return dP        
 def naive_all_against_all():
@@ -996,6 +1260,7 @@ def naive_all_against_all():
     
     iRow = len(dataset1)
     iCol = len(dataset2)
+    config.association_scores = {}
     
     aOut = [] 
     aFinal = []
@@ -1003,11 +1268,23 @@ def naive_all_against_all():
     tests = []
     passed_tests = []
     #print iRow, iCol
+    # pairs whose analytic p-value is above the screening cut-off cannot pass
+    # the FDR correction; they keep that p-value and skip the permutation test
+    bScreen = config.alla_screen > 0 and metric in distance.c_hash_metric_cross
+    if bScreen:
+        aP_screen, aSim_screen = stats.analytic_pvalues(dataset1, dataset2)
+        fScreen = max(config.alla_screen, fQ)
     for i, j in itertools.product(range(iRow), range(iCol)):
         test =  Hypothesis_Node(left_distance=0.0, right_distance=0.0)
         data = [[i], [j]]
         test = add_data(test, data)
+        if bScreen and aP_screen[i, j] > fScreen:
+            test.pvalue = aP_screen[i, j]
+            test.similarity_score = aSim_screen[i, j]
+            test.significance = False
         tests.append(test)
+    if bScreen:
+        print "--- %s of %s pairs passed the analytic screening" % (numpy.sum(aP_screen <= fScreen), iRow * iCol)
     
     p_values = multiprocessing_actor(_actor, tests, pMethod, dataset1, dataset2)
     cluster_size = [1 for i in range(len(p_values))]
@@ -1099,6 +1376,7 @@ def hypotheses_testing():
     X, Y = dataset1, dataset2 
     aOut = []  # # Full log 
     aFinal = []  # # Only the final reported values 
+    config.association_scores = {}
     def _level_by_level_testing():
         apChildren = [pTree]
         level = 1
@@ -1150,7 +1428,7 @@ def hypotheses_testing():
             p_values = multiprocessing_actor(_actor, current_level_tests, pMethod, dataset1, dataset2)
             for i in range(len(current_level_tests)):
                 current_level_tests[i].pvalue = p_values[i]
-            cluster_size = [ len(current_level_tests[i].m_pData[0])*len(current_level_tests[i].m_pData[1]) for i in range(len(current_level_tests)) ]
+            cluster_size = hypotheses_cluster_size(current_level_tests)
             total_cluster_size = numpy.sum(cluster_size)
             q = config.q 
             aP_adjusted, pRank = stats.p_adjust(p_values, q, cluster_size)#config.q)
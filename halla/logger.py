@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 
+import gzip
 import logging
+import numpy
 import pylab
 import sys
 
@@ -54,16 +56,45 @@ def _log_plot(pData, pTest, adTotal):
 		["Total", "Perm", "Boot"])
 	figr.savefig("-".join((s.split("|")[-1] for s in (pOne.m_strID, pTwo.m_strID))) + ".png")
 
-def write_table(data=None, name=None, rowheader=None, colheader=None, prefix = "label",  corner = None, delimiter= '\t'):
+c_iBuffer = 1 << 20  # bytes buffered by the table writers
+c_iBlockRows = 256  # rows formatted and written per call
+
+def _open_table(name):
+    """
+    Opens a table for writing through a large buffer; a name ending in
+    ".gz" is written gzip-compressed
+    """
+    if name.endswith(".gz"):
+        return gzip.open(name, 'wb')
+    return open(name, 'w', c_iBuffer)
+
+def _write_rows(f, data, astrRowStart, fmt=None, delimiter='\t'):
+    """
+    Writes row i of data as astrRowStart[i] followed by its values, a block
+    of rows per write. Values are written with str() unless fmt, a
+    printf-style format such as "%.6g", is given and the data is numeric;
+    it is then applied to whole rows at once, as numpy.savetxt does.
+    """
+    if fmt is not None and len(data) and numpy.asarray(data[:1]).dtype.kind in "biuf":
+        strRow = delimiter.join([fmt] * len(data[0]))
+        _format = lambda pRow: strRow % tuple(pRow.tolist() if isinstance(pRow, numpy.ndarray) else pRow)
+    else:
+        _format = lambda pRow: delimiter.join(map(str, pRow))
+    for iStart in range(0, len(data), c_iBlockRows):
+        iStop = min(iStart + c_iBlockRows, len(data))
+        f.write(''.join([astrRowStart[i] + _format(data[i]) + '\n' for i in range(iStart, iStop)]))
+
+def write_table(data=None, name=None, rowheader=None, colheader=None, prefix = "label",  corner = None, delimiter= '\t', fmt = None):
     
     '''
     wite a matrix of data in tab-delimated format file
     
     input:
     data: a 2 dimensioal array of data
-    name: includes path and the name of file to save
+    name: includes path and the name of file to save; gzip-compressed if it ends with ".gz"
     rowheader
     columnheader
+    fmt: printf-style format of the values (e.g. "%.6g"); str() of each value by default
     
     output:
     a file tabdelimated file 
@@ -72,115 +103,57 @@ def write_table(data=None, name=None, rowheader=None, colheader=None, prefix = "
     if data is None:
     	print "Null input for writing table"
     	return
-    f = open(name, 'w')
     # row numbers as header
     if colheader is None:
-        if corner is None:
-            f.write(delimiter)
-        else:
-            f.write(corner)
-            f.write(delimiter)
-        for i in range(len(data[0])):
-            f.write(str(i))
-            if i < len(data[0]) - 1:
-                f.write(delimiter)
-        f.write('\n')
+        astrHeader = [str(i) for i in range(len(data[0]))]
     elif len(colheader) == len(data[0]):
-        if corner is None:
-            f.write(delimiter)
-        else:
-            f.write(corner)
-            f.write(delimiter)
-        for i in range(len(data[0])):
-            f.write(colheader[i])
-            if i < len(data[0]) - 1:
-                f.write(delimiter)
-        f.write('\n')
+        astrHeader = [colheader[i] for i in range(len(data[0]))]
     else:
         print("The label list in not matched with the data size")
         sys.exit()
-        
-    for i in range(len(data)):
-        if rowheader is None :
-            f.write(prefix+str(i))
-            f.write(delimiter)
-        else:
-            f.write(rowheader[i])
-            f.write(delimiter)
-        for j in range(len(data[i])):
-                f.write(str(data[i][j]))
-                if j < len(data[i]) - 1:
-                    f.write(delimiter)
-        f.write('\n')
+    f = _open_table(name)
+    f.write(("" if corner is None else corner) + delimiter + delimiter.join(astrHeader) + '\n')
+    if rowheader is None:
+        astrRowStart = [prefix + str(i) + delimiter for i in range(len(data))]
+    else:
+        astrRowStart = [rowheader[i] + delimiter for i in range(len(data))]
+    _write_rows(f, data, astrRowStart, fmt, delimiter)
     f.close() 
     
-def write_circos_table(data, name=None, rowheader=None, colheader=None, prefix = "label",  corner = None, delimiter= '\t'):
+def write_circos_table(data, name=None, rowheader=None, colheader=None, prefix = "label",  corner = None, delimiter= '\t', fmt = None):
     
     '''
     wite a matrix of data in tab-delimated format file
     
     input:
     data: a 2 dimensioal array of data
-    name: includes path and the name of file to save
+    name: includes path and the name of file to save; gzip-compressed if it ends with ".gz"
     rowheader
     columnheader
+    fmt: printf-style format of the values (e.g. "%.6g"); str() of each value by default
     
     output:
     a file tabdelimated file 
     
     '''
-    f = open(name, 'w')
-    
-    # write order header
-    f.write("Data")
-    f.write(delimiter)
-    f.write("Data")
-    f.write(delimiter)
-    for i in range(len(data[0])):
-            f.write(str(i+1))
-            if i < len(data[0]) - 1:
-                f.write(delimiter)
-    f.write('\n')
     # column numbers as header
-    f.write("Data")
-    f.write(delimiter)
     if len(colheader) == 0:
-        f.write("Data")
-        f.write(delimiter)
-        for i in range(len(data[0])):
-            f.write(str(i))
-            if i < len(data[0]) - 1:
-                f.write(delimiter)
-        f.write('\n')
+        astrHeader = [str(i) for i in range(len(data[0]))]
     elif len(colheader) == len(data[0]):
-        f.write("Data")
-        f.write(delimiter)
-        for i in range(len(data[0][:])):
-            f.write(colheader[i])
-            if i < len(data[0]) - 1:
-                f.write(delimiter)
-        f.write('\n')
+        astrHeader = [colheader[i] for i in range(len(data[0][:]))]
     else:
         sys.err("The lable list in not matched with the data size")
         sys.exit()
-    
-    for i in range(len(data)):
-        if len(rowheader) == 0:
-            f.write(str(i+len(data[0])))
-            f.write(prefix+str(i))
-            f.write(delimiter)
-        elif len(colheader) == len(data[0]):
-            f.write(str(i+len(data[0])+1))
-            f.write(delimiter)
-            f.write(rowheader[i])
-            f.write(delimiter)
-        else:
-            sys.err("The lable list in not matched with the data size")
-            sys.exit()
-        
-        for j in range(len(data[i])):
-                f.write(str(data[i][j]))
-                if j < len(data[i]) - 1:
-                    f.write(delimiter)
-        f.write('\n')
-    f.close() 
\ No newline at end of file
+    if len(rowheader) == 0:
+        astrRowStart = [str(i+len(data[0])) + prefix+str(i) + delimiter for i in range(len(data))]
+    elif len(colheader) == len(data[0]):
+        astrRowStart = [str(i+len(data[0])+1) + delimiter + rowheader[i] + delimiter for i in range(len(data))]
+    else:
+        sys.err("The lable list in not matched with the data size")
+        sys.exit()
+    f = _open_table(name)
+    # write order header
+    f.write("Data" + delimiter + "Data" + delimiter + delimiter.join([str(i+1) for i in range(len(data[0]))]) + '\n')
+    f.write("Data" + delimiter + "Data" + delimiter + delimiter.join(astrHeader) + '\n')
+    _write_rows(f, data, astrRowStart, fmt, delimiter)
+    f.close() 
@@ -5,6 +5,7 @@ manages transformations
 '''
 
 import csv
+import os
 import re
 import sys
 from numpy import array
@@ -67,6 +68,261 @@ def load(file):
 	file_handle.close()
 		
 	return np.array(data)
+
+# a row of plain decimal numbers; fromstring stops quietly at the first cell
+# that is not one ("3abc" reads as 3), so only these rows take the block path
+c_strNumber = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+c_reNumericRow = re.compile(r"^%s(?:\t%s)*$" % (c_strNumber, c_strNumber))
+
+def load_table(file, bVar=True, bHeaders=False, iChunk=4096):
+	"""
+	Streaming counterpart of load followed by parse_table (without imputation).
+
+	The comment, header and variable-name rules are the same, but numeric rows
+	are parsed straight into float64 blocks of iChunk rows instead of keeping
+	every cell as a string. Rows that do not parse as plain numbers (lexical
+	values, missing values, quoted cells) fall back to the cell-by-cell rules.
+
+	Returns aOut, aNames, aTypes, aHeaders as parse_table does; aOut is a float64
+	matrix when every row was parsed as a numeric block.
+	"""
+	try:
+		file_handle=open(file)
+	except EnvironmentError:
+		sys.exit("Error: Unable to read file: " + file)
+	
+	def _cells(strLine):
+		return next(csv.reader([strLine], csv.excel_tab))
+	
+	# Ignore comment lines in input file
+	strComment = None
+	strLine = None
+	for strLine in file_handle:
+		strLine = strLine.rstrip("\r\n")
+		if re.match("#", strLine):
+			strComment = strLine
+			strLine = None
+		else:
+			# First data line found
+			break
+	if strLine is None:
+		file_handle.close()
+		return [], [], [], None
+	
+	# The last comment is the header if it has the same number of columns,
+	# otherwise the first data line is when headers are requested
+	aHeaders = None
+	if strComment is not None and len(_cells(strComment)) == len(_cells(strLine)):
+		aHeaders = _cells(strComment)[1:]
+	elif bHeaders:
+		aHeaders = _cells(strLine)[1:]
+		strLine = None
+	
+	# stripping the missing character must not be able to change a number
+	bBlock = not set(config.missing_char or "") & set("0123456789.+-iIfFyY")
+	aNames = []
+	aTypes = []
+	aiRows = []
+	apSlowRows = []
+	aaBlocks = []
+	iBlockRow = iChunk
+	def _lines():
+		if strLine is not None:
+			yield strLine
+		for strNext in file_handle:
+			yield strNext.rstrip("\r\n")
+	for i, strNext in enumerate(_lines()):
+		if bVar:
+			strName, _, strValues = strNext.partition("\t")
+		else:
+			strName, strValues = "", strNext
+		aValues = None
+		# a quoted name is left to the csv reader to unquote
+		if bBlock and '"' not in strName and c_reNumericRow.match(strValues):
+			aValues = np.fromstring(strValues, sep="\t")
+			if len(aValues) != strValues.count("\t") + 1:
+				aValues = None
+		if aValues is not None:
+			if iBlockRow == iChunk:
+				aaBlocks.append(np.empty((iChunk, len(aValues))))
+				iBlockRow = 0
+			aaBlocks[-1][iBlockRow] = aValues
+			iBlockRow += 1
+			aiRows.append(len(aiRows) - len(apSlowRows))
+			aTypes.append("CON")
+		else:
+			line = _cells(strNext)
+			if bVar:
+				strName = line[0]
+				line = line[1:]
+			line = map(lambda x: (x.strip(config.missing_char) if bool(x.strip(config.missing_char)) 
+								else np.nan), line)  ###### np.nan Convert missings to nans
+			try:
+				line = map(float, line)  # is it continuous? 
+				aTypes.append("CON")
+			except ValueError:
+				# we are forced to conclude that it is implicitly categorical, with some lexical ordering 
+				aTypes.append("LEX")
+			aiRows.append(None)
+			apSlowRows.append(line)
+		if bVar:
+			aNames.append(substitute_special_characters(wrap_features(str(strName))))
+		elif not aNames:
+			aNames.append(i)
+	file_handle.close()
+	
+	if not aiRows:
+		return [], aNames, aTypes, aHeaders
+	pBlock = None
+	if aaBlocks:
+		aaBlocks[-1] = aaBlocks[-1][:iBlockRow]
+		pBlock = np.concatenate(aaBlocks) if len(aaBlocks) > 1 else aaBlocks[0]
+	if not apSlowRows:
+		return pBlock, aNames, aTypes, aHeaders
+	apSlowRows.reverse()
+	aOut = [pBlock[iRow] if iRow is not None else apSlowRows.pop() for iRow in aiRows]
+	return aOut, aNames, aTypes, aHeaders
+
+def cache_key(strFileName1, strFileName2, bVar, bHeaders):
+	"""
+	Hash of the content of both input files and of every setting that
+	changes the parsed, discretized and filtered datasets
+	"""
+	import hashlib
+	pHash = hashlib.sha1()
+	for strFileName in [strFileName1, strFileName2]:
+		try:
+			file_handle = open(strFileName, 'rb')
+		except EnvironmentError:
+			sys.exit("Error: Unable to read file: " + strFileName)
+		for strBlock in iter(lambda: file_handle.read(1 << 20), ''):
+			pHash.update(strBlock)
+		file_handle.close()
+		pHash.update('\0')
+	bImpute = bool(config.missing_method) and not distance.c_hash_association_method_discretize[config.similarity_method]
+	pHash.update(repr((bVar, bHeaders, config.missing_char, config.missing_method, bImpute,
+		config.strDiscretizing, config.NBIN, config.entropy_threshold, config.min_var, config.similarity_method == 'dmic')))
+	return pHash.hexdigest()
+
+def save_cache(strPath, aOut):
+	"""
+	Writes the datasets returned by Input.get to the directory strPath:
+	one .npy per array, so numeric arrays can be memory-mapped back,
+	and the names, data types and headers in labels.npz
+	"""
+	strTemp = strPath + ".tmp%d" % os.getpid()
+	os.makedirs(strTemp)
+	hashLabels = {}
+	for i, (pDiscretized, pOriginal, aNames, aTypes, aHeaders) in enumerate(aOut):
+		np.save(os.path.join(strTemp, "discretized%d.npy" % i), np.asarray(pDiscretized))
+		np.save(os.path.join(strTemp, "original%d.npy" % i), np.asarray(pOriginal))
+		hashLabels["names%d" % i] = np.array([str(strName) for strName in aNames])
+		hashLabels["types%d" % i] = np.array(aTypes)
+		hashLabels["headers%d" % i] = np.array([] if aHeaders is None else [str(strHead) for strHead in aHeaders])
+		hashLabels["has_headers%d" % i] = np.array(aHeaders is not None)
+	np.savez(os.path.join(strTemp, "labels.npz"), **hashLabels)
+	try:
+		os.rename(strTemp, strPath)
+	except OSError:
+		# another run stored the same datasets first
+		import shutil
+		shutil.rmtree(strTemp, ignore_errors=True)
+
+def load_cache(strPath):
+	"""
+	Reads the datasets written by save_cache, in the layout of Input.get;
+	numeric arrays are memory-mapped copy-on-write
+	"""
+	def _load_array(strName):
+		strFile = os.path.join(strPath, strName)
+		try:
+			return np.load(strFile, mmap_mode='c')
+		except ValueError:
+			# arrays of python objects (lexical rows) can not be memory-mapped
+			return np.load(strFile, allow_pickle=True)
+	pLabels = np.load(os.path.join(strPath, "labels.npz"))
+	aOut = []
+	for i in range(2):
+		aHeaders = pLabels["headers%d" % i].tolist() if pLabels["has_headers%d" % i] else None
+		aOut.append((_load_array("discretized%d.npy" % i), _load_array("original%d.npy" % i),
+			pLabels["names%d" % i].tolist(), pLabels["types%d" % i].tolist(), aHeaders))
+	pLabels.close()
+	return aOut
+
+def parse_table(pArray, bVar, bHeaders):
+	"""
+	Parses a string table from load: header, variable names, missing values
+	and the CON/LEX type of every row. Returns aOut, aNames, aTypes, aHeaders.
+	"""
+ 
+	aOut = [] 
+	aNames = []
+	aTypes = []
+	aHeaders = None
+	
+	# Parse header if indicated by user or "#"
+	if bHeaders or re.match("#",pArray[0,0]):
+		aHeaders = list(pArray[0,1:])
+		pArray = pArray[1:]
+
+	# Parse variable names
+	if bVar: 
+		aNames =  list(pArray[:, 0])
+		aNames = map(str, aNames)
+		aNames = map(wrap_features, aNames)
+		aNames = map(substitute_special_characters, aNames)
+		pArray = pArray[:, 1:]
+
+	# # Parse data types, missing values, and whitespace
+	if config.missing_method:
+		from sklearn.preprocessing import Imputer
+		imp = Imputer(missing_values='NaN', strategy=config.missing_method, axis=1)
+		imp.fit(pArray)
+	#Imputer(axis=0, copy=True, missing_values='NaN', strategy='mean', verbose=0)
+	#line = [[np.nan, 2], [6, np.nan], [7, 6]]
+	#print imp 
+ 
+	for i, line in enumerate(pArray):
+		# *   If the line is not full,  replace the Nones with nans                                           *
+		#***************************************************************************************************** 
+		if config.missing_method is  None: #and not distance.c_hash_association_method_discretize[config.similarity_method]:
+			#warn_message ="There is missing data in feature "+  aNames[i]+"!!! " + "Try --missing-method=method to fill missing data. "
+			line = map(lambda x: (x.strip(config.missing_char) if bool(x.strip(config.missing_char)) 
+								else np.nan), line)  ###### np.nan Convert missings to nans
+		else:
+			line = map(lambda x: (x.strip(config.missing_char) if bool(x.strip(config.missing_char)) else np.nan ), line)  ###### np.nan Convert missings to nans
+			#line = df1 = pd.DataFrame(line)
+			if not distance.c_hash_association_method_discretize[config.similarity_method]:
+				try:
+					line = imp.transform(line)[0]
+				except:
+					print "there is an issue with filling missed data!"
+			#print line 
+		if all(val != config.missing_char for val in line):
+			if not aNames:
+				aNames.append(i)
+
+			#try: 
+				#line = map(int, line)  # is it explicitly categorical?  
+				#aTypes.append("CAT")
+			#except ValueError:
+			try:
+				line = map(float, line)  # is it continuous? 
+				aTypes.append("CON")
+				#print "Continues data !"
+			except ValueError:
+				#print "Categorical data !"
+				line = line  # we are forced to conclude that it is implicitly categorical, with some lexical ordering 
+				aTypes.append("LEX")
+			aOut.append(line)
+		else:  # delete corresponding name from namespace 
+			try:
+				print aNames[i], " has an issue with filling missed data!"
+				#aNames.remove(aNames[i])
+			except Exception:
+				pass  
+	return aOut, aNames, aTypes, aHeaders 
+
 class Input:
 	"""
 	
@@ -109,12 +365,28 @@ class Input:
 		self.outHead1 = None
 		self.outHead2 = None 
 		
-		self._load()
-		self._parse()
-		self._filter_to_common_columns()
-		print "Discretizing is started using: ", config.strDiscretizing, " style!"
-		self._discretize()
-		self._remove_low_entropy_features()
+		strCache = None
+		if config.cache_dir:
+			strCache = os.path.join(config.cache_dir, cache_key(self.strFileName1, self.strFileName2, self.varNames, self.headers))
+		if strCache and os.path.isdir(strCache):
+			print "Using the parsed datasets cached in: ", strCache
+			((self.discretized_dataset1, self.orginal_dataset1, self.outName1, self.outType1, self.outHead1), 
+				(self.discretized_dataset2, self.orginal_dataset2, self.outName2, self.outType2, self.outHead2)) = load_cache(strCache)
+			config.data_type[0] = self.outType1
+			config.data_type[1] = self.outType2
+			print "--- %d features and %d samples are used from first dataset" % (len(self.discretized_dataset1), len(self.discretized_dataset1[0]))
+			print "--- %d features and %d samples are used from second dataset" % (len(self.discretized_dataset2), len(self.discretized_dataset2[0]))
+		else:
+			self._load()
+			self._parse()
+			self._filter_to_common_columns()
+			print "Discretizing is started using: ", config.strDiscretizing, " style!"
+			self._discretize()
+			self._remove_low_entropy_features()
+			if strCache:
+				if not os.path.isdir(config.cache_dir):
+					os.makedirs(config.cache_dir)
+				save_cache(strCache, self.get())
 		if store.bypass_discretizing():
 			try:
 				self.orginal_dataset1= np.asarray(self.orginal_dataset1, dtype = float)
@@ -136,8 +408,10 @@ class Input:
 			(self.discretized_dataset2, self.orginal_dataset2, self.outName2, self.outType2, self.outHead2)] 
 		
 	def _load(self):
-		self.orginal_dataset1 = load(self.strFileName1)
-		self.orginal_dataset2 = load(self.strFileName2)
+		# without imputation the files are streamed by load_table in _parse
+		if config.missing_method:
+			self.orginal_dataset1 = load(self.strFileName1)
+			self.orginal_dataset2 = load(self.strFileName2)
 		
 	
 	def _discretize(self):
@@ -145,78 +419,12 @@ class Input:
 	    self.discretized_dataset2 = stats.discretize(self.orginal_dataset2, style = config.strDiscretizing, data_type = config.data_type[1])
 	   
 	def _parse(self):
-		def __parse(pArray, bVar, bHeaders):
- 
-			aOut = [] 
-			aNames = []
-			aTypes = []
-			aHeaders = None
-			
-			# Parse header if indicated by user or "#"
-			if bHeaders or re.match("#",pArray[0,0]):
-				aHeaders = list(pArray[0,1:])
-				pArray = pArray[1:]
-
-			# Parse variable names
-			if bVar: 
-				aNames =  list(pArray[:, 0])
-				aNames = map(str, aNames)
-				aNames = map(wrap_features, aNames)
-				aNames = map(substitute_special_characters, aNames)
-				pArray = pArray[:, 1:]
-
-			# # Parse data types, missing values, and whitespace
-			if config.missing_method:
-				from sklearn.preprocessing import Imputer
-				imp = Imputer(missing_values='NaN', strategy=config.missing_method, axis=1)
-				imp.fit(pArray)
-			#Imputer(axis=0, copy=True, missing_values='NaN', strategy='mean', verbose=0)
-			#line = [[np.nan, 2], [6, np.nan], [7, 6]]
-			#print imp 
- 
-			for i, line in enumerate(pArray):
-				# *   If the line is not full,  replace the Nones with nans                                           *
-				#***************************************************************************************************** 
-				if config.missing_method is  None: #and not distance.c_hash_association_method_discretize[config.similarity_method]:
-					#warn_message ="There is missing data in feature "+  aNames[i]+"!!! " + "Try --missing-method=method to fill missing data. "
-					line = map(lambda x: (x.strip(config.missing_char) if bool(x.strip(config.missing_char)) 
-										else np.nan), line)  ###### np.nan Convert missings to nans
-				else:
-					line = map(lambda x: (x.strip(config.missing_char) if bool(x.strip(config.missing_char)) else np.nan ), line)  ###### np.nan Convert missings to nans
-					#line = df1 = pd.DataFrame(line)
-					if not distance.c_hash_association_method_discretize[config.similarity_method]:
-						try:
-							line = imp.transform(line)[0]
-						except:
-							print "there is an issue with filling missed data!"
-					#print line 
-				if all(val != config.missing_char for val in line):
-					aOut.append(line)
-					if not aNames:
-						aNames.append(i)
-
-					#try: 
-						#line = map(int, line)  # is it explicitly categorical?  
-						#aTypes.append("CAT")
-					#except ValueError:
-					try:
-						line = map(float, line)  # is it continuous? 
-						aTypes.append("CON")
-						#print "Continues data !"
-					except ValueError:
-						#print "Categorical data !"
-						line = line  # we are forced to conclude that it is implicitly categorical, with some lexical ordering 
-						aTypes.append("LEX")
-				else:  # delete corresponding name from namespace 
-					try:
-						print aNames[i], " has an issue with filling missed data!"
-						#aNames.remove(aNames[i])
-					except Exception:
-						pass  
-			return aOut, aNames, aTypes, aHeaders 
-
-		self.orginal_dataset1, self.outName1, self.outType1, self.outHead1 = __parse(self.orginal_dataset1, self.varNames, self.headers)
-		self.orginal_dataset2, self.outName2, self.outType2, self.outHead2 = __parse(self.orginal_dataset2, self.varNames, self.headers)
+		if config.missing_method:
+			self.orginal_dataset1, self.outName1, self.outType1, self.outHead1 = parse_table(self.orginal_dataset1, self.varNames, self.headers)
+			self.orginal_dataset2, self.outName2, self.outType2, self.outHead2 = parse_table(self.orginal_dataset2, self.varNames, self.headers)
+		else:
+			self.orginal_dataset1, self.outName1, self.outType1, self.outHead1 = load_table(self.strFileName1, self.varNames, self.headers)
+			self.orginal_dataset2, self.outName2, self.outType2, self.outHead2 = load_table(self.strFileName2, self.varNames, self.headers)
 		config.data_type[0] = self.outType1
 		config.data_type[1] = self.outType2
 	def _filter_to_common_columns(self):
@@ -334,13 +542,14 @@ class Input:
 		#print df1.var(), np.var(df2, axis=1)
 		l1_before =  len(df1.index)
 		l2_before =  len(df2.index)
-		temp_df1 = df1 
-		df1 = df1[df1.apply(stats.get_enropy, 1) > config.entropy_threshold]
-		df1_org = df1_org[temp_df1.apply(stats.get_enropy, 1) > config.entropy_threshold]
+		# one entropy pass per dataset gives the mask of both frames
+		bKeep1 = stats.entropy_rows(self.discretized_dataset1) > config.entropy_threshold
+		df1 = df1[bKeep1]
+		df1_org = df1_org[bKeep1]
 		
-		temp_df2 = df2 
-		df2 = df2[df2.apply(stats.get_enropy, 1) > config.entropy_threshold]
-		df2_org = df2_org[temp_df2.apply(stats.get_enropy, 1) > config.entropy_threshold]
+		bKeep2 = stats.entropy_rows(self.discretized_dataset2) > config.entropy_threshold
+		df2 = df2[bKeep2]
+		df2_org = df2_org[bKeep2]
 		
 		l1_after = len(df1.index)
 		l2_after = len(df2.index)
@@ -17,6 +17,7 @@ import scipy
 import scipy.stats
 import sys
 import random
+import zlib
 from scipy.stats import scoreatpercentile, pearsonr, rankdata, percentileofscore, spearmanr
 
 import sklearn 
@@ -64,6 +65,33 @@ def get_enropy(x):
 		observed_entropy = -sum([p * numpy.log2(p) for p in P])
 	#max_entropy = numpy.log2(len(P))
 	return observed_entropy#/max_entropy
+
+def entropy_rows(pArray):
+	"""
+	get_enropy of every row of a discretized matrix at once; the rows are
+	offset into disjoint ranges of one flat bincount
+	"""
+	d = numpy.asarray(pArray, dtype=float)
+	iRows, n = d.shape
+	if iRows == 0:
+		return numpy.zeros(0)
+	aMin = d.min(axis=1)
+	if not numpy.all((aMin == 0) | (aMin == 1)):
+		sys.exit("entropy error")
+	d = (d - (aMin == 1)[:, None]).astype(int)
+	aMax = d.max(axis=1)
+	iBins = aMax.max() + 1
+	aCounts = numpy.bincount((d + iBins * numpy.arange(iRows)[:, None]).ravel(), minlength=iRows * iBins)
+	P = aCounts.reshape(iRows, iBins) / float(n)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		aTerms = P * numpy.log2(P)
+	# get_enropy only sees the bins up to each row's maximum
+	aTerms[numpy.arange(iBins) > aMax[:, None]] = 0.0
+	# summed bin by bin in the order of get_enropy's sum()
+	observed_entropy = 0
+	for iBin in range(iBins):
+		observed_entropy = observed_entropy + aTerms[:, iBin]
+	return -observed_entropy
 def scale_data(X, scale = 'log'):
 	if scale == 'sqrt':
 		y = numpy.sqrt(numpy.abs(X)) * numpy.sign(X)
@@ -229,7 +257,7 @@ def pca(pArray, iComponents=1):
 	 # print "pArray:", pArray
 	 try:
 	 	iRow, iCol = pArray.shape 
-	 	pPCA = PCA(n_components=iComponents)
+	 	pPCA = PCA(n_components=iComponents, random_state=config.random_state)
 		# # doing this matrix inversion twice doesn't seem to be a good idea 
 		# print"PCA:",   pPCA.fit_transform( pArray.T ).T 
 		# print "End PCA"
@@ -330,7 +358,7 @@ def ica(pArray, iComponents=1):
 	 
 	 try:
 	 	iRow, iCol = pArray.shape 
-	 	pICA = FastICA(n_components=iComponents)
+	 	pICA = FastICA(n_components=iComponents, random_state=config.random_state)
 		# # doing this matrix inversion twice doesn't seem to be a good idea 
 		return pICA.fit_transform(pArray.T).T 
 
@@ -424,26 +452,40 @@ def get_medoid_centroid(pArray, iAxis=0, pMetric=distance.l2):
 	pArrayCenter = pArray - (mean_vec * numpy.ones(pArray.shape))
 	#print pArray[numpy.argsort(map(numpy.linalg.norm, pArrayCenter))[0], :]
 	return pArray[numpy.argsort(map(numpy.linalg.norm, pArrayCenter))[0], :]
-def medoid(pArray, iAxis=0, pMetric=distance.nmi):
+def medoid(pArray, iAxis=0, pMetric=distance.nmi, aiFeatures=None, iDataset=None):
 	"""
 	Input: numpy array 
 	Output: float
+
+	If the rows of pArray are the features aiFeatures of dataset iDataset,
+	their distances are read from config.Distance[iDataset] (computed by
+	hclust) and the medoid of each cluster is looked up only once.
 	"""
 	#X = pArray
     #return X[len(X)/2]
 	#return pArray[len(pArray) -1, :]
+	if aiFeatures is not None and config.Distance[iDataset] is not None:
+		key = tuple(aiFeatures)
+		if key not in config.medoid_cache[iDataset]:
+			D = config.Distance[iDataset][numpy.ix_(aiFeatures, aiFeatures)]
+			config.medoid_cache[iDataset][key] = _medoid_index(D)
+		return pArray[config.medoid_cache[iDataset][key], :]
 	D = squareform(pdist(pArray, metric=distance.pDistance))
 	#print D
+	#print "medoid index :", medoid_index, len(pArray)-1
+	return pArray[_medoid_index(D), :]
+def _medoid_index(D):
+	"""
+	Index of the row of the distance matrix D with the smallest mean distance
+	"""
 	medoid_index = 0
 	med = 1.0 
 	#i = 0
-	for i in range(len(D)):
-		temp_mean = numpy.mean(D[i])
+	for i, temp_mean in enumerate(D.mean(axis=1)):
 		if temp_mean <= med:
 			med = temp_mean
 			medoid_index = i
-	#print "medoid index :", medoid_index, len(pArray)-1
-	return pArray[medoid_index, :]
+	return medoid_index
 def concat(pArray, iAxis=0, pMetric=distance.nmi):
 	"""
 	Input: numpy array 
@@ -755,22 +797,196 @@ def estimate_p_value(observed_value, random_distribution):
     # The most precise a p-value we can predict is not 0, but 1 / N
 	# where N is the number of permutations.
     num_permutations = len(random_distribution)
-    M = num_exceedances = len([score for score in random_distribution
-            if score >= observed_value]) 
+    M = num_exceedances(random_distribution, observed_value, bInclusive = True)
     if M > 10:
-        return float(num_exceedances) / num_permutations
+        return float(M) / num_permutations
     else:
     	#from scipy.stats import genpareto
     	#genpareto.cdf(random_distribution, observed_value)
-        return float(num_exceedances) / num_permutations
+        return float(M) / num_permutations
+def random_state_for(key):
+	"""
+	A random stream of its own for key (any value with a stable repr), seeded
+	from config.seed and the key, so it gives the same draws in any process
+	and whatever was drawn before it
+	"""
+	return numpy.random.RandomState([config.seed % 2**32, zlib.crc32(repr(key)) & 0xffffffff])
+
+def hypothesis_key(aIndicies):
+	"""
+	Stable key of a hypothesis: its bags of feature indices in the two datasets
+	"""
+	return (tuple(int(i) for i in aIndicies[0]), tuple(int(j) for j in aIndicies[1]))
+
+def set_hypothesis_random_state(aIndicies):
+	"""
+	Makes the stream of the hypothesis with the bags aIndicies the one the
+	permutation tests draw from (config.random_state)
+	"""
+	config.random_state = random_state_for(hypothesis_key(aIndicies))
+
 def null_fun(X, Y):
 	strMetric = config.similarity_method
 	pHashDecomposition = c_hash_decomposition
 	pHashMetric = distance.c_hash_metric 
 	pMe = pHashMetric[strMetric]
-	return math.fabs(pMe(X, numpy.random.permutation(Y)))
-def permutation_test_pvalue(X, Y):
-	 
+	return math.fabs(pMe(X, config.random_state.permutation(Y)))
+def null_fun_batch(X, Y, iSamples, pRandom = None):
+	"""
+	Draws iSamples null scores at once: builds an (iSamples x n) matrix of
+	permutation indices and scores every permuted copy of Y in one pass.
+	Consumes the random stream (pRandom, config.random_state by default)
+	exactly as iSamples calls of null_fun.
+	"""
+	if pRandom is None:
+		pRandom = config.random_state
+	strMetric = config.similarity_method
+	n = len(Y)
+	aiPerm = array([pRandom.permutation(n) for _ in xrange(iSamples)], dtype=int).reshape(iSamples, n)
+	if strMetric in distance.c_hash_metric_permuted:
+		return list(numpy.fabs(distance.c_hash_metric_permuted[strMetric](X, Y, aiPerm)))
+	pMe = distance.c_hash_metric[strMetric]
+	Y = array(Y)
+	return [math.fabs(pMe(X, Y[aiPermRow])) for aiPermRow in aiPerm]
+class NullSamples(object):
+	"""
+	Null scores of a permutation test, kept sorted as they are added, so that
+	exceedance counts and tail slices take a binary search instead of a scan
+	"""
+	def __init__(self, aScores = ()):
+		self._aBuffer = numpy.sort(numpy.asarray(aScores, dtype=float))
+		self._iSize = len(self._aBuffer)
+		
+	def __len__(self):
+		return self._iSize
+	
+	def sorted(self):
+		"""
+		The scores in ascending order (a view, valid until the next add)
+		"""
+		return self._aBuffer[:self._iSize]
+	
+	def add(self, aScores):
+		"""
+		Merges new scores in, growing the buffer by doubling
+		"""
+		aScores = numpy.sort(numpy.asarray(aScores, dtype=float))
+		iSize = self._iSize + len(aScores)
+		if iSize > len(self._aBuffer):
+			aBuffer = numpy.empty(max(iSize, 2 * len(self._aBuffer)))
+			aBuffer[:self._iSize] = self.sorted()
+			self._aBuffer = aBuffer
+		aOld = self.sorted().copy()
+		aiNew = numpy.searchsorted(aOld, aScores, side = 'right') + numpy.arange(len(aScores))
+		abOld = numpy.ones(iSize, dtype=bool)
+		abOld[aiNew] = False
+		self._aBuffer[:iSize][abOld] = aOld
+		self._aBuffer[aiNew] = aScores
+		self._iSize = iSize
+	
+	def exceedances(self, x, bInclusive = False):
+		"""
+		Number of scores greater than x, or at least x if bInclusive; NaN
+		scores (a constant permuted representative) never exceed x
+		"""
+		aSorted = self.sorted()
+		# NaN sorts last, so the scores that compare are the ones before it
+		iScores = numpy.searchsorted(aSorted, numpy.nan, side = 'left')
+		return max(0, iScores - numpy.searchsorted(aSorted, x, side = 'left' if bInclusive else 'right'))
+
+def num_exceedances(null_samples, x, bInclusive = False):
+	"""
+	Number of null scores greater than x (at least x if bInclusive) in a
+	NullSamples or a plain sequence of scores
+	"""
+	if isinstance(null_samples, NullSamples):
+		return null_samples.exceedances(x, bInclusive = bInclusive)
+	aScores = numpy.asarray(null_samples, dtype=float)
+	return int(numpy.count_nonzero(aScores >= x if bInclusive else aScores > x))
+
+# metrics whose permutation null depends only on the two marginal histograms
+c_null_by_marginals = ["nmi", "mi", "ami"]
+
+def null_cache_entry(X, Y):
+	"""
+	Returns the shared null distribution entry for the representatives X and Y,
+	or None if the metric's null is not determined by the marginals.
+
+	Under permutation, the null of an information measure depends only on the
+	sorted bin counts of X and Y. Each entry samples from canonical vectors
+	with those counts and its own random stream seeded from the key and
+	config.seed, so its samples do not depend on which test asked first.
+	"""
+	if not config.use_null_cache or config.similarity_method not in c_null_by_marginals:
+		return None
+	aiXCounts = numpy.sort(distance._encode(X)[1])
+	aiYCounts = numpy.sort(distance._encode(Y)[1])
+	key = (config.similarity_method, tuple(aiXCounts), tuple(aiYCounts))
+	if key not in config.null_cache:
+		config.null_cache[key] = {"X": numpy.repeat(numpy.arange(len(aiXCounts)), aiXCounts),
+								  "Y": numpy.repeat(numpy.arange(len(aiYCounts)), aiYCounts),
+								  "random": random_state_for(key),
+								  "samples": [],
+								  "gpd": None}
+	return config.null_cache[key]
+
+def cached_null_samples(pNull, iSamples):
+	"""
+	Returns the first iSamples null scores of a null_cache_entry, drawing more if needed
+	"""
+	if len(pNull["samples"]) < iSamples:
+		pNull["samples"] += null_fun_batch(pNull["X"], pNull["Y"], iSamples - len(pNull["samples"]), pRandom = pNull["random"])
+	return pNull["samples"][:iSamples]
+
+def sequential_test_pvalue(fAssociation, X, Y, pNull = None, iBlock = 10):
+	"""
+	Sequential (Besag-Clifford) permutation p-value of the observed score fAssociation.
+
+	Null scores are drawn iBlock at a time with a running count of those at
+	least as large as fAssociation. Sampling stops as soon as
+	  * config.sequential_exceedances exceedances are seen after i draws: p = h / i
+	  * a Jeffreys credible interval for p lies above config.q, or below the
+	    smallest threshold config.p_adjust_method can use for this many tests;
+	    then, or after config.iterations draws, p = (exceedances + 1) / (draws + 1)
+	pNull, if given, supplies the null scores (see permutation_test_pvalue).
+	"""
+	iIter = config.iterations
+	h = config.sequential_exceedances
+	m = len(config.FeatureNames[0]) * len(config.FeatureNames[1])
+	fHigh = config.q
+	if config.p_adjust_method == "bhy":
+		fLow = config.q / (m * numpy.sum(1.0 / numpy.arange(1, m + 1)))
+	elif config.p_adjust_method in ["bh", "bonferroni"]:
+		fLow = config.q / m
+	else:
+		fLow = config.q
+	# the same per-test confidence nonparametric_test_pvalue asks for
+	fEps = .05 / m
+	iExceed = 0
+	i = 0
+	while i < iIter:
+		iDraw = min(iBlock, iIter - i)
+		if pNull is not None:
+			aScores = cached_null_samples(pNull, i + iDraw)[i:]
+		else:
+			aScores = null_fun_batch(X, Y, iDraw)
+		for fScore in aScores:
+			i += 1
+			if fScore >= fAssociation:
+				iExceed += 1
+				if iExceed >= h:
+					return float(iExceed) / i
+		if scipy.stats.beta.ppf(fEps, iExceed + .5, i - iExceed + .5) > fHigh or \
+				scipy.stats.beta.ppf(1.0 - fEps, iExceed + .5, i - iExceed + .5) < fLow:
+			break
+	return (iExceed + 1.0) / (i + 1.0)
+
+def permutation_test_pvalue(X, Y, pNull = None):
+	"""
+	P-value of the similarity of X and Y against their permutation null.
+	pNull, a null_cache_entry or an entry with precomputed null scores,
+	takes the place of drawing the null for this test.
+	"""
 	strMetric = config.similarity_method 
 	seed = config.seed
 	iIter = config.iterations
@@ -804,16 +1020,35 @@ def permutation_test_pvalue(X, Y):
 		return pval
 
 	few_permutation = False
-	if config.permutation_func == 'ecdf':
+	if config.permutation_func == 'ecdf' and config.sequential_exceedances > 0 and not config.use_one_null_dist:
+		if pNull is None:
+			pNull = null_cache_entry(X, Y)
+		fP = sequential_test_pvalue(fAssociation, X, Y, pNull = pNull)
+	elif config.permutation_func == 'ecdf':
 		iter = iIter
+		if pNull is None and not config.use_one_null_dist:
+			pNull = null_cache_entry(X, Y)
 		if config.use_one_null_dist:
 			if len(config.nullsamples) == 0:
 				config.nullsamples = generate_null_dist(X,Y)
 			aDist = config.nullsamples
+		elif pNull is not None:
+			# the same early stopping as below, on the shared null samples
+			for i in xrange(0, iIter, 50):
+				iter = i
+				aDist = cached_null_samples(pNull, i + 1)
+				new_fP2 = _calculate_pvalue(i)
+				if new_fP2 > fP:
+					break
+				else:
+					fP = new_fP2
+			else:
+				iter = iIter - 1
+				aDist = cached_null_samples(pNull, iIter)
 		else:
 			for i in xrange(iIter):
 				iter = i
-				permuted_Y = numpy.random.permutation(Y)
+				permuted_Y = config.random_state.permutation(Y)
 				fAssociation_permuted = math.fabs(pMe(X, permuted_Y))  
 				aDist.append(fAssociation_permuted)
 				if i % 50 == 0:
@@ -825,7 +1060,7 @@ def permutation_test_pvalue(X, Y):
 						fP = new_fP2
 		fP = _calculate_pvalue(iter)
 	elif config.permutation_func == 'gpd':
-		fP = nonparametric_test_pvalue(X, Y)
+		fP = nonparametric_test_pvalue(X, Y, pNull = pNull)
 	#print "Estimated P-value:",fP
 	'''import matplotlib.pyplot as plt
 	print sim_score, fP 
@@ -847,16 +1082,62 @@ def generate_null_dist(X, Y):
 	pMe = pHashMetric[config.similarity_method]
 	n_samples = []
 	for i in xrange(config.iterations):
-		numpy.random.seed(i+config.seed)
+		# a fresh stream per sample, as reseeding numpy's global one did
 		iter = i
-		permuted_Y = numpy.random.permutation(Y)
+		permuted_Y = numpy.random.RandomState(i+config.seed).permutation(Y)
 		fAssociation_permuted = math.fabs(pMe(X, permuted_Y))  
 		n_samples.append(fAssociation_permuted)	
 	return n_samples
-def permutation_test_by_representative(pArray1, pArray2):
+def representative(pArray, iDataset, aiFeatures=None):
+	"""
+	Returns (representative, explained variance, loading) of the cluster pArray
+	of dataset iDataset for the configured decomposition. With aiFeatures, the
+	feature indices of its rows, it is looked up in config.representative_cache.
+	"""
+	decomposition = config.decomposition
+	strMetric = config.similarity_method
+	pDe = c_hash_decomposition[decomposition]
+	pRandom = config.random_state
+	if aiFeatures is not None:
+		key = (tuple(aiFeatures), decomposition, strMetric)
+		if key in config.representative_cache[iDataset]:
+			return config.representative_cache[iDataset][key]
+		# randomized decompositions draw from a stream of the cluster, so a
+		# cached representative does not depend on which test computed it
+		config.random_state = random_state_for((iDataset, tuple(int(i) for i in aiFeatures)))
+	rep_variance = 1.0
+	loading = []
+	try:
+		if decomposition == 'mca':
+			pRep, rep_variance, loading = mca_method(pArray, discretize_style = config.strDiscretizing) #mean(pArray1)#[len(pArray1)/2]
+			if bool(distance.c_hash_association_method_discretize[strMetric]):
+				pRep = discretize(pRep)
+		elif decomposition == 'medoid':
+			if aiFeatures is None:
+				pRep = medoid(pArray)
+			else:
+				pRep = medoid(pArray, aiFeatures = aiFeatures, iDataset = iDataset)
+		elif decomposition == "pca":
+			(pRep, rep_variance, loading) = pDe(pArray)
+			if bool(distance.c_hash_association_method_discretize[strMetric]):
+				pRep = discretize(pRep)
+		elif decomposition == "ica":
+			pRep = discretize(pDe(pArray))[0] if bool(distance.c_hash_association_method_discretize[strMetric]) else pDe(pArray)[0]
+		else:
+			pRep = discretize(pDe(pArray))[0] if bool(distance.c_hash_association_method_discretize[strMetric]) else pDe(pArray)
+	finally:
+		# the test's own stream, also when the decomposition fails
+		config.random_state = pRandom
+	if aiFeatures is not None:
+		config.representative_cache[iDataset][key] = (pRep, rep_variance, loading)
+	return (pRep, rep_variance, loading)
+
+def permutation_test_by_representative(pArray1, pArray2, aIndicies=None):
 	"""
 	Input: 
 	pArray1, pArray2, metric = "mi", decomposition = "pca", iIter = 1000
+	aIndicies: optional feature indices of the rows of pArray1 and pArray2
+	in config.parsed_dataset, to reuse the distances computed by hclust
 
 	"""
 	metric = config.similarity_method
@@ -879,6 +1160,9 @@ def permutation_test_by_representative(pArray1, pArray2):
 	right_rep_variance = 1.0
 	left_loading = []
 	right_loading = []
+	def _representative(pArray, iDataset):
+		return representative(pArray, iDataset, aiFeatures = None if aIndicies is None else aIndicies[iDataset])
+
 	#print pArray1[0]
 	#### Calculate Point estimate
 	if (len(pArray1) == 1 and len(pArray2) == 1) or decomposition =="none":
@@ -893,27 +1177,11 @@ def permutation_test_by_representative(pArray1, pArray2):
 		left_loading = [1.0]
 		right_loading = [1.0]
 		
-	elif decomposition == 'mca':
-		pRep1, left_rep_variance, left_loading = mca_method(pArray1, discretize_style = discretize_style) #mean(pArray1)#[len(pArray1)/2]
-		pRep2, right_rep_variance, right_loading = mca_method(pArray2, discretize_style = discretize_style)#mean(pArray2)#[len(pArray2)/2]	
-		if bool(distance.c_hash_association_method_discretize[strMetric]):
-			[pRep1, pRep2] = [discretize(aRep) for aRep in [pRep1, pRep2] ]
-		#print len(pArray1)," Rep 1: ", pRep1,
-		#print len(pArray2)," Rep 2: ", pRep2, 
-		#print "Sim: ", pMe(pRep1, pRep2)
-	elif decomposition == 'medoid':
-		pRep1 = medoid(pArray1)
-		pRep2 = medoid(pArray2)
-	elif decomposition == "pca":
-		[(pRep1, left_rep_variance, left_loading) , (pRep2, right_rep_variance, right_loading)] = [pDe(pA) for pA in [pArray1, pArray2]]
-		if bool(distance.c_hash_association_method_discretize[strMetric]):
-			[pRep1, pRep2] = [discretize(aRep) for aRep in [pRep1, pRep2] ]
-	elif decomposition == "ica":
-		[pRep1, pRep2] = [discretize(pDe(pA))[0] for pA in [pArray1, pArray2] ] if bool(distance.c_hash_association_method_discretize[strMetric]) else [pDe(pA)[0] for pA in [pArray1, pArray2]]
 	elif decomposition in ['pls', 'cca']:
 		[pRep1, pRep2] = discretize(pDe(pArray1, pArray2, metric)) if bool(distance.c_hash_association_method_discretize[strMetric]) else pDe(pArray1, pArray2, metric)
 	else:
-		[pRep1, pRep2] = [discretize(pDe(pA))[0] for pA in [pArray1, pArray2] ] if bool(distance.c_hash_association_method_discretize[strMetric]) else [pDe(pA) for pA in [pArray1, pArray2]]
+		(pRep1, left_rep_variance, left_loading) = _representative(pArray1, 0)
+		(pRep2, right_rep_variance, right_loading) = _representative(pArray2, 1)
 
 	sim_score= pMe(pRep1, pRep2)
 	fP = permutation_test_pvalue(X=pRep1, Y=pRep2)
@@ -1277,15 +1545,96 @@ def permutation_test_by_average(pArray1, pArray2, metric= "nmi", iIter=1000):
 
 	return dPPerm
 
-def permutation_test(pArray1, pArray2):
+def permutation_test(pArray1, pArray2, aIndicies=None):
 	
 	if config.decomposition in ['none','cca', 'pls',"pca", "dpca", "nlpca", "ica", "kpca","centroid-medoid","medoid","mean", "mca"]:
-		return permutation_test_by_representative(pArray1, pArray2)
+		return permutation_test_by_representative(pArray1, pArray2, aIndicies = aIndicies)
 	
 	if config.decomposition in ["average"]:
 		return permutation_test_by_average(pArray1, pArray2, metric=metric, iIter=iIter)
 
 
+# decompositions whose representatives are rows of the datasets, so a level
+# of hypotheses can be stacked and tested by permutation_test_by_level
+c_level_decomposition = ["none", "medoid"]
+
+def permutation_test_by_level(aaIndicies):
+	"""
+	Tests a level of hypotheses at once, each given by its feature indices
+	[features in dataset 1, features in dataset 2].
+
+	The representatives of all hypotheses are stacked into two (H x n)
+	arrays and scored against one (iterations x n) permutation matrix shared
+	by the level; the null of each hypothesis then goes through the usual
+	p-value estimate. Returns the (p-value, similarity score) of each hypothesis.
+	"""
+	strMetric = config.similarity_method
+	pMe = distance.c_hash_metric[strMetric]
+	apReps = [[], []]
+	for aIndicies in aaIndicies:
+		bRows = (len(aIndicies[0]) == 1 and len(aIndicies[1]) == 1) or config.decomposition == "none"
+		for iDataset in [0, 1]:
+			pArray = config.parsed_dataset[iDataset][array(aIndicies[iDataset])]
+			if bRows:
+				apReps[iDataset].append(pArray[0, :])
+			else:
+				apReps[iDataset].append(representative(pArray, iDataset, aiFeatures = aIndicies[iDataset])[0])
+	X, Y = array(apReps[0]), array(apReps[1])
+	n = Y.shape[1]
+	# nonparametric_test_pvalue starts from 100 null samples
+	iSamples = max(config.iterations, 100) if config.permutation_func == 'gpd' else config.iterations
+	# the level's permutations come from a stream keyed by all of its hypotheses
+	config.random_state = random_state_for(tuple(hypothesis_key(aIndicies) for aIndicies in aaIndicies))
+	aiPerm = array([config.random_state.permutation(n) for _ in xrange(iSamples)], dtype=int).reshape(iSamples, n)
+	aaNull = numpy.fabs(distance.c_hash_metric_level[strMetric](X, Y, aiPerm))
+	aResults = []
+	for h in xrange(len(X)):
+		pNull = {"X": X[h], "Y": Y[h], "random": config.random_state, "samples": list(aaNull[h]), "gpd": None}
+		aResults.append((permutation_test_pvalue(X[h], Y[h], pNull = pNull), pMe(X[h], Y[h])))
+	return aResults
+
+def analytic_pvalues(pArray1, pArray2, fMinExpected = 5.0):
+	"""
+	Cheap analytic p-values of every pair (row of pArray1, row of pArray2),
+	used to screen all-against-all tests before the permutation engine.
+	For nmi and mi, G = 2 N MI (in nats) is taken as chi-square with
+	(kx - 1)(ky - 1) degrees of freedom; for pearson and spearman,
+	r sqrt((n - 2) / (1 - r^2)) as Student's t with n - 2.
+	The chi-square approximation can undercut the permutation p-value on
+	sparse contingency tables, so pairs with an expected cell count below
+	fMinExpected get p-value 0 and are left to the permutation test.
+	Returns the (F1 x F2) p-values and similarity scores.
+	"""
+	strMetric = config.similarity_method
+	n = len(pArray1[0])
+	if strMetric in ["nmi", "mi"]:
+		# one pass gives the mutual information and the level counts the
+		# similarity, degrees of freedom and expected counts follow from
+		aMI, aiXCounts, aiKX, aiYCounts, aiKY = distance._information_cross_counts(pArray1, pArray2)
+		if strMetric == "mi":
+			aSim = math.log(math.e, 2) * aMI
+		else:
+			aSim = distance._normalize_information(aMI, aiXCounts, aiKX, aiYCounts, aiKY)
+		aiDf = numpy.outer(aiKX - 1, aiKY - 1)
+		# the smallest expected count of a table is its smallest row count
+		# times its smallest column count over n
+		aExpected = numpy.outer(array([aiXCounts[i, :aiKX[i]].min() for i in range(len(aiKX))]),
+			array([aiYCounts[j, :aiKY[j]].min() for j in range(len(aiKY))])) / float(n)
+		aP = numpy.ones(aSim.shape)
+		# too sparse a table for the chi-square approximation: p-value 0
+		# means the pair is never screened out and always permuted
+		aP[aExpected < fMinExpected] = 0.0
+		abDf = (aiDf > 0) & (aExpected >= fMinExpected)
+		aP[abDf] = scipy.stats.chi2.sf(2 * n * aMI[abDf], aiDf[abDf])
+	else:
+		aSim = distance.c_hash_metric_cross[strMetric](pArray1, pArray2)
+		with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+			aT = numpy.fabs(aSim) * numpy.sqrt((n - 2) / (1.0 - aSim * aSim))
+		aP = 2 * scipy.stats.t.sf(aT, n - 2)
+	# pairs without a score (missing values) are left to the permutation test
+	aP[numpy.isnan(aP)] = 0.0
+	return aP, aSim
+
 def g_test(pArray1, pArray2, metric, decomposition, iIter):
 	if decomposition in ['cca', 'pls',"pca", "nlpca", "ica", "kpca"]:
 		return g_test_by_representative(pArray1, pArray2, metric=metric, decomposition= decomposition, iIter=iIter)
@@ -1756,6 +2105,10 @@ def discretize(pArray, style = "equal-area", data_type = None, number_of_bins=No
 		number_of_bins= config.NBIN
 	discretized_data = [] 
 	if isinstance(pArray[0], list) or (hasattr(pArray[0], "__len__") and (not isinstance(pArray[0], str))):
+		# a numeric matrix has all its continuous rows discretized at once
+		aContinuous = None
+		if isinstance(pArray, numpy.ndarray) and pArray.ndim == 2 and pArray.dtype.kind in 'biuf':
+			aContinuous = discretize_rows(pArray, number_of_bins)
 		for i, line in enumerate(pArray):
 			if i in aiSkip:
 				#print "SKIPE LINE!"
@@ -1763,6 +2116,8 @@ def discretize(pArray, style = "equal-area", data_type = None, number_of_bins=No
 			elif data_type!= None and data_type[i] == 'LEX':
 				#print "LEX", line
 				discretized_data.append(array(_discretize_categorical(line, number_of_bins)))
+			elif aContinuous is not None:
+				discretized_data.append(aContinuous[i])
 			else:
 				discretized_data.append(_discretize_continuous(line, number_of_bins))
 	else:
@@ -1773,6 +2128,53 @@ def discretize(pArray, style = "equal-area", data_type = None, number_of_bins=No
 
 	return array(discretized_data)
 
+def discretize_rows(pArray, number_of_bins=None):
+	"""
+	Equal-area discretization of every row of a numeric matrix at once.
+
+	Gives the codes of discretize's continuous rows: a row with no more
+	distinct values than bins keeps its dense ranks; otherwise the "min"
+	ranks are cut into bins of ceil(n/bins) and densely renumbered from 1,
+	with 0 for NaNs. NaNs count as distinct values, as in set() of a row.
+
+	>>> discretize_rows( [[0.4, 0.2, 0.6, 0.1, 0.3, 0.5], [0, 0, 0, 0, 0, 1]] )
+	array([[2, 1, 2, 1, 1, 2],
+	       [1, 1, 1, 1, 1, 2]])
+	"""
+	pArray = numpy.asarray(pArray, dtype=float)
+	iRows, n = pArray.shape
+	aRows = numpy.arange(iRows)[:, None]
+	aiSort = numpy.argsort(pArray, axis=1)  # NaNs last
+	aSorted = pArray[aRows, aiSort]
+	
+	# tie groups in sorted order: dense ranks and "min" ranks
+	bNew = numpy.ones((iRows, n), dtype=bool)
+	bNew[:, 1:] = aSorted[:, 1:] != aSorted[:, :-1]
+	aDense = numpy.cumsum(bNew, axis=1)
+	aUnique = aDense[:, -1]
+	aMin = numpy.maximum.accumulate(numpy.where(bNew, numpy.arange(n), 0), axis=1) + 1
+	
+	if number_of_bins == None:
+		aBins = numpy.minimum(aUnique, round(math.sqrt(n)))
+		if config.similarity_method == 'dmic':
+			aBins = aBins * 2
+	elif number_of_bins == 0:
+		aBins = aUnique
+	else:
+		aBins = numpy.minimum(number_of_bins, aUnique)
+	aBinSize = numpy.ceil(n / aBins.astype(float))
+	aCode = ((aMin - 1) / aBinSize[:, None]).astype(int)
+	
+	# the bins are non-decreasing in sorted order, so their dense ranks are a cumsum
+	bNewBin = numpy.ones((iRows, n), dtype=bool)
+	bNewBin[:, 1:] = aCode[:, 1:] != aCode[:, :-1]
+	aBinned = numpy.cumsum(bNewBin, axis=1)
+	aBinned[numpy.isnan(aSorted)] = 0
+	
+	aOut = numpy.empty((iRows, n), dtype=int)
+	aOut[aRows, aiSort] = numpy.where((aUnique <= aBins)[:, None], aDense, aBinned)
+	return aOut
+
 def _discretize_continuous_old_R(astrValues, number_of_bins=None, style =None):
 	if style in ['jenks', 'kmeans', 'hclust']:
 		try:
@@ -1952,6 +2354,36 @@ import scipy.stats
 import numpy
 import math
 
+# Machine epsilon, below which a GPD shape is taken as 0 (exponential)
+GPD_EPS = 7./3. - 4./3. - 1.
+
+def gpd_negloglike(parms, data):
+	"""
+	Negative log-likelihood of a GPD with location 0 and parameters
+	(shape, log scale) on the array data, with its gradient
+	"""
+	shape = parms[0]
+	lnscale = parms[1]
+	n = len(data)
+	Z = data / math.exp(lnscale)
+	if abs(shape) > GPD_EPS:
+		# Non-exponential
+		if shape > 0 or Z.max() < -1/shape:
+			aKZ = shape * Z
+			if (aKZ <= -1).any():
+				return float('inf'), numpy.zeros(2)
+			sumln1pkz = numpy.log1p(aKZ).sum()
+			sumzkz = (Z / (1 + aKZ)).sum()
+			return (n * lnscale + (1 + 1/shape) * sumln1pkz,
+				array([-sumln1pkz / (shape * shape) + (1 + 1/shape) * sumzkz,
+					n - (1 + shape) * sumzkz]))
+		else:
+			return float('inf'), numpy.zeros(2)
+	else:
+		# Limiting exponential distribution as shape -> 0
+		sumz = Z.sum()
+		return n * lnscale + sumz, array([sumz - .5 * numpy.dot(Z, Z), n - sumz])
+
 def estimate_gpd_params_ML(samples):
 	"""
 	Maximum likelihood estimate of the GPD from the given samples
@@ -1959,12 +2391,13 @@ def estimate_gpd_params_ML(samples):
 	"""
 
 	# Implements gpfit.m from Matlab
+	samples = numpy.asarray(samples, dtype=float)
 	
 	# Get an initial guess from the Method of Moments
 	n = len(samples)
 	xmean = numpy.mean(samples)
 	xvar = numpy.var(samples)
-	xmax = max(samples)
+	xmax = samples.max()
 	xsnr = xmean * xmean / xvar
 	shape0 = -.5 * (xsnr - 1)
 	scale0 = .5 * xmean * (xsnr + 1)
@@ -1973,35 +2406,13 @@ def estimate_gpd_params_ML(samples):
 		shape0 = 0
 		scale0 = xmean
 		
-	# Negative log-like function
-	EPS = 7./3. - 4./3. - 1. # Machine epsilon
-	def negloglike(parms, data):
-		shape = parms[0]
-		lnscale = parms[1]
-		scale = math.exp(lnscale)
-
-		n = len(data)
-		#print scale
-		
-		Z = [x / scale for x in data]
-		
-		if abs(shape) > EPS:
-			# Non-exponential
-			if shape > 0 or max(Z) < -1/shape:
-				try:
-					sumln1pkz = sum([math.log1p(shape*z) for z in Z])
-				except ValueError:
-					return None
-				return n * lnscale + (1 + 1/shape) * sumln1pkz
-			else:
-				return float('inf')#math.inf
-		else:
-			# Limiting exponential distribution as shape -> 0
-			return n * lnscale + sum(Z)
-	
-	# Find the ML estimate numerically
-	result = scipy.optimize.minimize(negloglike, (shape0, math.log(scale0)),
-		method='Nelder-Mead', args=(samples), options={'disp': False})
+	# Find the ML estimate numerically: BFGS on the analytic gradient, or
+	# Nelder-Mead if its line search runs into the edge of the GPD support
+	result = scipy.optimize.minimize(gpd_negloglike, (shape0, math.log(scale0)),
+		method='BFGS', jac=True, args=(samples,), options={'disp': False})
+	if not result.success or not numpy.isfinite(result.fun):
+		result = scipy.optimize.minimize(lambda parms, data: gpd_negloglike(parms, data)[0], (shape0, math.log(scale0)),
+			method='Nelder-Mead', args=(samples,), options={'disp': False})
 	shapehat = result.x[0]
 	scalehat = math.exp(result.x[1])
 	return (shapehat, scalehat)
@@ -2027,8 +2438,12 @@ def estimate_tail_gpd(samples):
 	# Algorithm proposed in Knijnenburg2009
 	
 	# Sort the samples so that the tail samples are easily accessible
-	sorted_samples = samples
-	sorted_samples.sort()
+	if isinstance(samples, NullSamples):
+		sorted_samples = samples.sorted()
+	else:
+		sorted_samples = samples
+		sorted_samples.sort()
+		sorted_samples = numpy.asarray(sorted_samples, dtype=float)
 	
 	# Minimum number of samples exceeding the threshold
 	minNexc = 10
@@ -2041,32 +2456,49 @@ def estimate_tail_gpd(samples):
 	# but definitely no more than N-1
 	# This is only problematic if N is < Nexc*2, which should never be the case
 	Nexc = min(len(samples)-1, max(minNexc, min(Nexc, int(math.floor(len(samples)/2)))))
-	while True:
-		# Fit the GPD to the samples
-		subsamples = sorted_samples[-Nexc:]
-		t = (sorted_samples[-Nexc] + subsamples[1]) / 2
-		(shape, scale) = estimate_gpd_params_ML([x - t for x in subsamples])
-		
-		if Nexc <= minNexc:
-			# Too few samples - have to go with what we have
-			# TODO: Emit warning?
-			break
-		
+	
+	# Candidate tail sizes, from Nexc down to minNexc in steps of dNexc;
+	# the last one is used whatever its fit
+	aNexc = [Nexc]
+	while aNexc[-1] > minNexc:
+		aNexc.append(max(minNexc, aNexc[-1] - dNexc))
+	fits = {}
+	def _fit(iNexc):
+		if iNexc not in fits:
+			# Fit the GPD to the samples
+			subsamples = sorted_samples[-iNexc:]
+			t = (sorted_samples[-iNexc] + subsamples[1]) / 2
+			(shape, scale) = estimate_gpd_params_ML(subsamples - t)
+			fits[iNexc] = (shape, t, scale, subsamples)
+		return fits[iNexc]
+	def _is_good_fit(iNexc):
 		# Does the GPD fit well with the samples?
-		gof = gpd_goodness_of_fit(shape, [(x - t) / scale for x in subsamples])
-		if gof < 0.05:
-			# The GPD doesn't fit this tail.. reduce the number of samples
-			Nexc = max(minNexc, Nexc - dNexc)
-		else:
-			# GPD is a good fit
-			break
+		(shape, t, scale, subsamples) = _fit(iNexc)
+		return gpd_goodness_of_fit(shape, (subsamples - t) / scale) >= 0.05
+	
+	# The largest tail usually fits; otherwise bisect for the largest tail
+	# that does, taking smaller tails to fit at least as well
+	if len(aNexc) == 1 or _is_good_fit(aNexc[0]):
+		Nexc = aNexc[0]
+	else:
+		iFail, iGood = 0, len(aNexc) - 1
+		while iGood - iFail > 1:
+			iMid = (iFail + iGood) // 2
+			if _is_good_fit(aNexc[iMid]):
+				iGood = iMid
+			else:
+				iFail = iMid
+		Nexc = aNexc[iGood]
+	(shape, t, scale, subsamples) = _fit(Nexc)
 
 	return (scipy.stats.genpareto(shape, loc=t, scale=scale), Nexc)
 
-def estimate_pvalue(x, null_samples,X, Y, regenrate_GPD_flag = False):
+def estimate_pvalue(x, null_samples,X, Y, regenrate_GPD_flag = False, pNull = None):
 	"""
 	Estimates the p-value, given the observed test statistic x and a set of
-	samples from the null distribution.
+	samples from the null distribution. If the samples come from a
+	null_cache_entry pNull, the GPD tail fitted to them is kept there and
+	reused while the entry has the same number of samples.
 	"""
 	
 	# Algorithm proposed in Knijnenburg2009
@@ -2074,19 +2506,23 @@ def estimate_pvalue(x, null_samples,X, Y, regenrate_GPD_flag = False):
 	if x == 0:
 		return 1.0
 	# Get M, the number of null samples greater than x
-	M = len([1 for v in null_samples if v > x])  # or v >= x 
+	M = num_exceedances(null_samples, x)  # or v >= x 
 	N = len(null_samples)
 	# Use the ECDF to approximate p-values if M > 10
 	if M >= 10:# or N < 100 or M >= .1 * N:
 		return float(M)/float(N)
 
 	# Estimate the generalized pareto distribtion from tail samples
-	if not config.use_one_null_dist or config.gp == None or regenrate_GPD_flag:
+	if pNull is not None and pNull["gpd"] is not None and pNull["gpd"][2] == N and not regenrate_GPD_flag:
+		(gp, Nexc) = pNull["gpd"][:2]
+	elif not config.use_one_null_dist or config.gp == None or regenrate_GPD_flag:
 		try:
 			#null_samples = list(set(null_samples))
 			(gp, Nexc) = estimate_tail_gpd(null_samples)
 			config.gp  = gp
 			config.Nexc = Nexc
+			if pNull is not None:
+				pNull["gpd"] = (gp, Nexc, N)
 		except ArithmeticError, ValueError:
 			return float(M)/float(N)
 	else:
@@ -2125,9 +2561,9 @@ def prob_pvalue_lt_samples(alpha, x, null_samples):
 	Probability that the p-value is less than alpha, given the test
 	statistic x and a set of samples from the null distribution
 	"""
-	return prob_pvalue_lt(alpha, len([1 for v in null_samples if v > x]), len(null_samples))
+	return prob_pvalue_lt(alpha, num_exceedances(null_samples, x), len(null_samples))
 
-def nonparametric_test_pvalue(X, Y, similarity_method = None,  alpha_cutoff = 0.05):
+def nonparametric_test_pvalue(X, Y, similarity_method = None,  alpha_cutoff = 0.05, pNull = None):
 	"""
 	Performs a permutation test of the significance of x, given the function
 	to sample the null distribution null_fun.
@@ -2138,6 +2574,7 @@ def nonparametric_test_pvalue(X, Y, similarity_method = None,  alpha_cutoff = 0.
 	 X: first vector
 	 Y: second vector
 	 similarity_method: the similarity method to be used
+	 pNull: optional entry holding the null scores to use (see permutation_test_pvalue)
 	"""
 	
 	# calculate imilarity between to orginal features
@@ -2157,20 +2594,28 @@ def nonparametric_test_pvalue(X, Y, similarity_method = None,  alpha_cutoff = 0.
 	
 	# Sample the null distribution until we've got enough to estimate the tail
 	# or if we're sure that the actual p-value is greater than the alpha cutoff
+	if pNull is None and not config.use_one_null_dist:
+		pNull = null_cache_entry(X, Y)
 	if config.use_one_null_dist and len(config.nullsamples) == 0:
-		nullsamples = [null_fun(X, Y) for val in range(0, max_samples)]
+		nullsamples = NullSamples(null_fun_batch(X, Y, max_samples))
+		config.nullsamples = nullsamples
+	elif pNull is not None:
+		# grow the shared null of these marginals only as far as this test needs
+		nullsamples = NullSamples(cached_null_samples(pNull, start_samples))
+		while len(nullsamples) < max_samples and prob_pvalue_lt_samples(config.q, sim_score, nullsamples) > .05 * 1.0/(len(config.FeatureNames[0])* len(config.FeatureNames[1])):
+			nullsamples.add(cached_null_samples(pNull, len(nullsamples) + sample_increments)[len(nullsamples):])
 		config.nullsamples = nullsamples
 	elif not config.use_one_null_dist: #or not config.use_one_null_dist:
-		nullsamples = [null_fun(X, Y) for val in range(0, start_samples)]
+		nullsamples = NullSamples(null_fun_batch(X, Y, start_samples))
 		while len(nullsamples) < max_samples and prob_pvalue_lt_samples(config.q, sim_score, nullsamples) > .05 * 1.0/(len(config.FeatureNames[0])* len(config.FeatureNames[1])):
 			#print("Gathering more.. N = %d; P(p<%f) = %.2f" % (len(nullsamples), config.q, prob_pvalue_lt_samples(config.q, x, nullsamples)))
-			nullsamples = [null_fun(X, Y) for val in range(0,sample_increments)] + nullsamples 
+			nullsamples.add(null_fun_batch(X, Y, sample_increments))
 		#nullsamples = [null_fun(X, Y) for val in range(0,max_samples)]
 
 		config.nullsamples = nullsamples
 	#print("Finished gathering: N = %d; P(p<%f) = %f" % (len(nullsamples), alpha_cutoff, prob_pvalue_lt_samples(alpha_cutoff, x, nullsamples)))
 	# Estimate the p-value from the current set of samples
-	return estimate_pvalue(x = sim_score, null_samples = config.nullsamples, X=X, Y=Y)
+	return estimate_pvalue(x = sim_score, null_samples = config.nullsamples, X=X, Y=Y, pNull = pNull)
 
 
 	
@@ -111,6 +111,7 @@ def set_parsed_data():
         config.parsed_dataset = config.original_dataset
     else:
         config.parsed_dataset = config.discretized_dataset
+    config.representative_cache = [{}, {}]
 
 def _hclust():
     # print config.discretized_dataset
@@ -155,126 +156,205 @@ def _naive_summary_statistics():
     config.meta_summary.append(np.reshape([p_values], (int(math.sqrt(len(p_values))), int(math.sqrt(len(p_values))))))
 
 
+class Association_Index(object):
+    """
+    Sparse summary of bag-by-bag results: one record per bag (the ranges of
+    its features in x_features and y_features, and a row of values) and,
+    per feature of the first dataset, the bags it belongs to. A cell (i, j)
+    takes the values of the last bag that covers it, as if the bags were
+    written one after another into a dense iX x iY matrix, and fFill when no
+    bag covers it. aaValues holds iValues values per bag.
+    """
+
+    def __init__(self, iX, iY, aBags, aaValues, iValues=1, fFill=-1.0):
+        self.iX, self.iY = iX, iY
+        self.fill = fFill
+        aiXCount = [len(aBag[0]) for aBag in aBags]
+        aiYCount = [len(aBag[1]) for aBag in aBags]
+        # the features of bag b are x_features[x_start[b]:x_start[b + 1]] and likewise for y
+        self.x_start = np.concatenate(([0], np.cumsum(aiXCount))).astype(int)
+        self.y_start = np.concatenate(([0], np.cumsum(aiYCount))).astype(int)
+        self.x_features = array([i for aBag in aBags for i in aBag[0]], dtype=int)
+        self.y_features = array([j for aBag in aBags for j in aBag[1]], dtype=int)
+        self.values = array(aaValues, dtype=float).reshape(len(aBags), iValues)
+        # the bags of feature i of the first dataset, ascending, are
+        # feature_bags[feature_start[i]:feature_start[i + 1]]
+        aiBag = np.repeat(np.arange(len(aBags)), aiXCount)
+        aiOrder = np.lexsort((aiBag, self.x_features))
+        self.feature_bags = aiBag[aiOrder]
+        self.feature_start = np.searchsorted(self.x_features[aiOrder], np.arange(iX + 1))
+
+    def __len__(self):
+        return len(self.values)
+
+    def row(self, i):
+        """
+        Returns the features of the second dataset covered together with
+        feature i of the first one, ascending, and the bag each cell takes
+        its values from
+        """
+        aiBags = self.feature_bags[self.feature_start[i]:self.feature_start[i + 1]]
+        if not len(aiBags):
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        aiY = np.concatenate([self.y_features[self.y_start[b]:self.y_start[b + 1]] for b in aiBags])
+        aiBag = np.repeat(aiBags, self.y_start[aiBags + 1] - self.y_start[aiBags])
+        aiOrder = np.lexsort((aiBag, aiY))
+        aiY, aiBag = aiY[aiOrder], aiBag[aiOrder]
+        abLast = np.append(aiY[1:] != aiY[:-1], True)
+        return aiY[abLast], aiBag[abLast]
+
+    def bags(self, i, j):
+        """
+        Returns the bags covering cell (i, j), ascending
+        """
+        return [b for b in self.feature_bags[self.feature_start[i]:self.feature_start[i + 1]]
+                if j in self.y_features[self.y_start[b]:self.y_start[b + 1]]]
+
+    def get(self, i, j):
+        aiBags = self.bags(i, j)
+        if not aiBags:
+            return np.repeat(self.fill, self.values.shape[1])
+        return self.values[aiBags[-1]]
+
+    def items(self):
+        """
+        Yields (i, j, values) for every covered cell in row-major order
+        """
+        for i in range(self.iX):
+            aiY, aiBag = self.row(i)
+            for j, b in zip(aiY, aiBag):
+                yield i, j, self.values[b]
+
+    def bag_array(self, aiX=None, aiY=None):
+        """
+        Matrix of the bag every cell takes its values from, -1 where no bag
+        covers it, over the rows aiX and columns aiY (all features by default)
+        """
+        aiX = range(self.iX) if aiX is None else aiX
+        aiY = np.arange(self.iY) if aiY is None else array(aiY, dtype=int)
+        aiColumn = -np.ones(self.iY, dtype=int)
+        aiColumn[aiY] = np.arange(len(aiY))
+        aiBags = -np.ones((len(aiX), len(aiY)), dtype=int)
+        for iRow, i in enumerate(aiX):
+            aiCovered, aiBag = self.row(i)
+            aiCovered = aiColumn[aiCovered]
+            abKeep = aiCovered >= 0
+            aiBags[iRow, aiCovered[abKeep]] = aiBag[abKeep]
+        return aiBags
+
+    def toarray(self, iColumn=0):
+        """
+        Dense iX x iY matrix of one value column, for small inputs
+        """
+        aiBags = self.bag_array()
+        pArray = np.empty(aiBags.shape)
+        pArray.fill(self.fill)
+        pArray[aiBags >= 0] = self.values[aiBags[aiBags >= 0], iColumn]
+        return pArray
+
+def _association_numbers(apAssociations, aiX, aiY):
+    """
+    Matrix of the number (1-based, in the given order) of the first of
+    apAssociations covering each cell of the rows aiX and columns aiY, 0 where
+    none does
+    """
+    # the last bag of the reversed list is the first association
+    pIndex = Association_Index(len(config.FeatureNames[0]), len(config.FeatureNames[1]),
+                               [pAssociation.m_pData for pAssociation in reversed(apAssociations)], [], iValues=0)
+    aiBags = pIndex.bag_array(aiX, aiY)
+    return np.where(aiBags >= 0, len(apAssociations) - aiBags, 0)
+
+def _similarity_table(aiX, aiY):
+    """
+    Similarity score of every pair of the features aiX of the first dataset
+    and aiY of the second one: the scores kept by hypothesis testing
+    (config.association_scores), and for the other pairs the metric's cross
+    kernel over the rows and columns that still miss some
+    """
+    aiX, aiY = array(aiX, dtype=int), array(aiY, dtype=int)
+    similarity_score = np.zeros(shape=(len(aiX), len(aiY)))
+    abKnown = np.zeros(similarity_score.shape, dtype=bool)
+    if config.association_scores:
+        aiRow = -np.ones(len(config.FeatureNames[0]), dtype=int)
+        aiRow[aiX] = np.arange(len(aiX))
+        aiColumn = -np.ones(len(config.FeatureNames[1]), dtype=int)
+        aiColumn[aiY] = np.arange(len(aiY))
+        aiPairs = array(list(config.association_scores.keys()), dtype=int)
+        aScores = array(list(config.association_scores.values()), dtype=float)
+        aiI, aiJ = aiRow[aiPairs[:, 0]], aiColumn[aiPairs[:, 1]]
+        abKeep = (aiI >= 0) & (aiJ >= 0)
+        similarity_score[aiI[abKeep], aiJ[abKeep]] = aScores[abKeep]
+        abKnown[aiI[abKeep], aiJ[abKeep]] = True
+    aiI = np.flatnonzero(~abKnown.all(axis=1))
+    aiJ = np.flatnonzero(~abKnown.all(axis=0))
+    if len(aiI) and len(aiJ):
+        pX = config.parsed_dataset[0][aiX[aiI]]
+        pY = config.parsed_dataset[1][aiY[aiJ]]
+        if config.similarity_method in distance.c_hash_metric_cross:
+            pBlock = distance.c_hash_metric_cross[config.similarity_method](pX, pY)
+        else:
+            pMe = distance.c_hash_metric[config.similarity_method]
+            pBlock = array([[pMe(pX[i], pY[j]) if not abKnown[aiI[i], aiJ[j]] else 0.0
+                             for j in range(len(aiJ))] for i in range(len(aiI))]).reshape(len(aiI), len(aiJ))
+        abMissing = ~abKnown[np.ix_(aiI, aiJ)]
+        similarity_score[np.ix_(aiI, aiJ)] = np.where(abMissing, pBlock, similarity_score[np.ix_(aiI, aiJ)])
+    return similarity_score
+
+def _circos_scores(similarity_score, aiAssociation):
+    """
+    |int(100 * similarity)| of the cells in an association, 0 elsewhere and
+    for scores that are not finite
+    """
+    aScore = np.fabs(np.trunc(similarity_score * 100))
+    aScore[~np.isfinite(aScore)] = 0
+    return np.where(aiAssociation > 0, aScore, 0.0)
+
 def _summary_statistics(strMethod=None): 
     """
     provides summary statistics on the output given by _hypotheses_testing 
+
+    config.meta_summary is an Association_Index of (p-value, q-value) per
+    cell (-1 where no bag covers it), config.outcome one of the final bags
+    (1.0 for associated cells, 0.0 otherwise) and config.pvalues one of the
+    p-values of all bags (0.0 elsewhere)
     """
 
     if not strMethod:
         strMethod = config.summary_method
-    # print('meta array:')
-    #print(config.original_dataset[0])
-    #print(config.original_dataset[1])    
     X = config.original_dataset[0]
     Y = config.original_dataset[1]
     iX, iY = len(X), len(Y)
-    S = -1 * np.ones((iX, iY , 2))  # # matrix of all associations; symmetric if using a symmetric measure of association  
     
     Z = config.meta_alla 
-    _final, _all = map(array, Z)  # # Z_final is the final bags that passed criteria; Z_all is all the associations delineated throughout computational tree
-    Z_final = array([[_final[i].m_pData, _final[i].pvalue, _final[i].qvalue] for i in range(len(_final))])
-    Z_all = array([[_all[i].m_pData, _all[i].pvalue, _all[i].qvalue] for i in range(len(_all))])    
+    _final, _all = Z  # # Z_final is the final bags that passed criteria; Z_all is all the associations delineated throughout computational tree
+    Z_final = [[_final[i].m_pData, _final[i].pvalue, _final[i].qvalue] for i in range(len(_final))]
+    Z_all = [[_all[i].m_pData, _all[i].pvalue, _all[i].qvalue] for i in range(len(_all))]
         
-    # ## Sort the final Z to make sure p-value consolidation happens correctly 
+    # ## Sort the final Z to make sure p-value consolidation happens correctly: 
+    # ## smaller bags come later and override the larger ones they overlap
     Z_final_dummy = [-1.0 * (len(line[0][0]) + len(line[0][1])) for line in Z_final]
     args_sorted = np.argsort(Z_final_dummy)
-    Z_final = Z_final[args_sorted]
+    Z_final = [Z_final[i] for i in args_sorted]
     if config.verbose == 'INFO':
         print (Z_final) 
+        print (Z_all) 
     # assert( Z_all.any() ), "association bags empty." ## Technically, Z_final could be empty 
-    def __set_outcome(Z_final):
-        #all_associations = 0.0
-        #intersection_1_2_count = 0.0
-        config.outcome = np.zeros((len(config.parsed_dataset[0]),len(config.parsed_dataset[1])))
-        
-        for aLine in Z_final:
-            if config.verbose == 'INFO':
-                print (aLine) 
-            
-            aaBag, _, _ = aLine
-            listBag1, listBag2 = aaBag 
-            #intersection_1_2 = [val for val in listBag1 if val in listBag2]
-            #all_associations += 1.0
-            #if len(intersection_1_2) < (len(listBag1)/2.0) and len(intersection_1_2) < (len(listBag2)/2.0):
-                  #intersection_1_2_count += 1 
-            for i, j in itertools.product(listBag1, listBag2):
-                config.outcome[i][j] = 1.0
-        #print "FDR= ", intersection_1_2_count/all_associations 
-    def __set_pvalues(Z_all):
-        config.pvalues = np.zeros((len(config.parsed_dataset[0]),len(config.parsed_dataset[1])))
-        
-        for aLine in Z_all:
-            if config.verbose == 'INFO':
-                print (aLine) 
-            
-            aaBag, pvalue, _ = aLine
-            listBag1, listBag2 = aaBag     
-            for i, j in itertools.product(listBag1, listBag2):
-                config.pvalues[i][j] = pvalue 
-        
-        
-    def __add_pval_product_wise(_x, _y, _fP, _fP_adjust):
-        S[_x][_y][0] = _fP
-        S[_x][_y][1] = _fP_adjust  
-
-    def __get_conditional_pval_from_bags(_Z, _strMethod=None):
-        """
-        
-        _strMethod: str 
-            {"default",}
-
-        The default option does the following: go through the bags, treating the p-value for each bag pair as applying to all the variables inside the bag. 
-        If new instance arises (e.g. [[3],[5]] following [[3,5,6],[3,5,6]] ), override the p-value to the one with more precision. 
-        """
-
-        for aLine in _Z:
-            if config.verbose == 'INFO':
-                print (aLine) 
-            
-            aaBag, fAssoc, fP_adjust = aLine
-            listBag1, listBag2 = aaBag 
-            #aBag1, aBag2 = array(listBag1), array(listBag2)
-            #print aBag1 , aBag2
-            for i, j in itertools.product(listBag1, listBag2):
-                S[i][j][0] = fAssoc 
-                S[i][j][1] = fP_adjust
-
-    def __get_pval_from_bags(_Z, _strMethod='final'):
-        """
-        
-        _strMethod: str 
-            {"default",}
-
-        The default option does the following: go through the bags, treating the p-value for each bag pair as applying to all the variables inside the bag. 
-        If new instance arises (e.g. [[3],[5]] following [[3,5,6],[3,5,6]] ), override the p-value to the one with more precision. 
-        """
 
-        for aLine in _Z:
-            if config.verbose == 'INFO':
-                print (aLine) 
-            
-            aaBag, fAssoc, P_adjust = aLine
-            aBag1, aBag2 = aaBag 
-            aBag1, aBag2 = array(aBag1), array(aBag2)
-            config.bc(aBag1, aBag2, pFunc=lambda x, y: __add_pval_product_wise(_x=x, _y=y, _fP=fAssoc, _fP_adjust=P_adjust))
-    __set_outcome(Z_final)
-    __set_pvalues(Z_all)
+    config.outcome = Association_Index(iX, iY, [aLine[0] for aLine in Z_final], [1.0] * len(Z_final), fFill=0.0)
+    config.pvalues = Association_Index(iX, iY, [aLine[0] for aLine in Z_all], [aLine[1] for aLine in Z_all], fFill=0.0)
     if strMethod == "final":
         if config.verbose == 'INFO':
             print ("Using only final p-values")
-        __get_conditional_pval_from_bags(Z_final)
-
-        #assert(S.any())
-        config.meta_summary = S
-        return config.meta_summary
-
+        _Z = Z_final
     elif strMethod == "all":
         if config.verbose == 'INFO':
             print ("Using all p-values")
-        __get_conditional_pval_from_bags(Z_all)
-        #assert(S.any())
-        config.meta_summary = S
-        return config.meta_summary
+        _Z = Z_all
+    else:
+        return
+    config.meta_summary = Association_Index(iX, iY, [aLine[0] for aLine in _Z], [aLine[1:] for aLine in _Z], iValues=2)
+    return config.meta_summary
+
 
 def _report():
     """
@@ -286,15 +366,9 @@ def _report():
     # config.meta_report = [] 
 
     aP = config.meta_summary
-    iRow1 = len(config.original_dataset[0])
-    iRow2 = len(config.original_dataset[1])
 
-    for i, j in itertools.product(range(iRow1), range(iRow2)):
-        # ## i <= j 
-        fQ = aP[i][j][0] 
-        fQ_adust = aP[i][j][1] 
-        if fQ != -1:
-            aaOut.append([[i, j], fQ, fQ_adust ])
+    for i, j, aValues in aP.items():
+        aaOut.append([[i, j], aValues[0], aValues[1] ])
 
     config.meta_report = aaOut
     # print "meta summary:", config.meta_report
@@ -556,10 +630,7 @@ def _report():
         X_labels_circos = np.array([re.sub('[^a-zA-Z0-9  \n\.]', '_', config.FeatureNames[0][i]).replace(' ','_') for i in config.Features_order[0]])
         Y_labels_circos = np.array([re.sub('[^a-zA-Z0-9  \n\.]', '_', config.FeatureNames[1][i]).replace(' ','_') for i in config.Features_order[1]])
         
-        similarity_score = np.zeros(shape=(len(config.Features_order[0]), len(config.Features_order[1])))  
-        for i in range(len(config.Features_order[0])):
-            for j in range(len(config.Features_order[1])):
-                similarity_score[i][j] = distance.c_hash_metric[config.similarity_method](config.parsed_dataset[0][config.Features_order[0][i]], config.parsed_dataset[1][config.Features_order[1][j]])
+        similarity_score = _similarity_table(config.Features_order[0], config.Features_order[1])
         #sorted_associations = sorted(config.meta_alla[0], key=lambda x: math.fabs(x.similarity_score), reverse=True)
         #sorted_associations = sorted(sorted_associations, key=lambda x: x.pvalue)
         sorted_associations = sorted(config.meta_alla[0], key=lambda x: (- math.fabs(x.similarity_score), x.pvalue, x.qvalue ))
@@ -570,26 +641,13 @@ def _report():
                 #similarity_score[i][j] = similarity_score[i][j]*2
                 pass         
        '''
-        def _is_in_an_assciostions(i,j):
-            for n in range(len(sorted_associations)):
-                iX, iY = sorted_associations[n].m_pData
-                if i in iX and j in iY:
-                    return n+1
-            return 0
-         
         '''with open('similarity_score.csv', 'w') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(Y_labels)
             [writer.writerow(r) for r in similarity_score] 
         '''
-        circos_tabel = np.zeros(shape=(len(config.Features_order[0]), len(config.Features_order[1])))
-        for i in range(len(config.Features_order[0])):
-            for j in range(len(config.Features_order[1])):
-                if _is_in_an_assciostions(config.Features_order[0][i],config.Features_order[1][j])>0: #for association in sorted_associations:
-                    try:
-                        circos_tabel[i][j] = math.fabs(int(similarity_score[i][j]*100))
-                    except:
-                        circos_tabel[i][j] = 0
+        anottation_cell = _association_numbers(sorted_associations, config.Features_order[0], config.Features_order[1])
+        circos_tabel = _circos_scores(similarity_score, anottation_cell)
         logger.write_circos_table(circos_tabel, str(config.output_dir)+"/" +"circos_table_"+ config.similarity_method+".txt", rowheader=X_labels_circos, colheader=Y_labels_circos, corner = "Data")         
         logger.write_table(similarity_score,str(config.output_dir)+"/" + "similarity_table.txt", rowheader=X_labels, colheader=Y_labels, corner = "#")
         return
@@ -612,10 +670,7 @@ def _report():
         X_labels_circos = np.array([re.sub('[^a-zA-Z0-9  \n\.]', '_', config.FeatureNames[0][i]).replace(' ','_') for i in config.Features_order[0]])
         Y_labels_circos = np.array([re.sub('[^a-zA-Z0-9  \n\.]', '_', config.FeatureNames[1][i]).replace(' ','_') for i in config.Features_order[1]])
         
-        similarity_score = np.zeros(shape=(len(config.Features_order[0]), len(config.Features_order[1])))  
-        for i in range(len(config.Features_order[0])):
-            for j in range(len(config.Features_order[1])):
-                similarity_score[i][j] = distance.c_hash_metric[config.similarity_method](config.parsed_dataset[0][config.Features_order[0][i]], config.parsed_dataset[1][config.Features_order[1][j]])
+        similarity_score = _similarity_table(config.Features_order[0], config.Features_order[1])
         sorted_associations = sorted(config.meta_alla[0], key=lambda x: (- math.fabs(x.similarity_score), x.pvalue, x.qvalue ))
         #sorted_associations = sorted(sorted_associations, key=lambda x: ( x.s)
         for association in sorted_associations:
@@ -624,29 +679,8 @@ def _report():
                 #similarity_score[i][j] = similarity_score[i][j]*2
                 pass         
        
-        def _is_in_an_assciostions(i,j):
-            for num, association in enumerate(sorted_associations):
-                iX, iY = association.m_pData
-                if i in iX and j in iY:
-                    return num+1
-            return 0
-
-        anottation_cell = np.zeros(shape=(len(config.Features_order[0]), len(config.Features_order[1])))                
-        for i in range(len(config.Features_order[0])):
-            for j in range(len(config.Features_order[1])):
-                association_num = _is_in_an_assciostions(config.Features_order[0][i],config.Features_order[1][j])
-                #print association_num
-                if association_num > 0: #for association in sorted_associations:
-                    anottation_cell[i][j] = association_num
-                    
-        circos_tabel = np.zeros(shape=(len(config.Features_order[0]), len(config.Features_order[1])))
-        for i in range(len(config.Features_order[0])):
-            for j in range(len(config.Features_order[1])):
-                if _is_in_an_assciostions(config.Features_order[0][i],config.Features_order[1][j])>0: #for association in sorted_associations:
-                    try:
-                        circos_tabel[i][j] = math.fabs(int(similarity_score[i][j]*100))
-                    except:
-                        circos_tabel[i][j] = 0
+        anottation_cell = _association_numbers(sorted_associations, config.Features_order[0], config.Features_order[1]).astype(float)
+        circos_tabel = _circos_scores(similarity_score, anottation_cell)
         logger.write_circos_table(circos_tabel, str(config.output_dir)+"/" +"circos_table_"+ config.similarity_method+".txt", rowheader=X_labels_circos, aSampleNames=Y_labels_circos, corner = "Data")         
         logger.write_table(similarity_score,str(config.output_dir)+"/" + "similarity_table.txt", rowheader=X_labels, aSampleNames=Y_labels, corner = "#")
         logger.write_table(anottation_cell,str(config.output_dir)+"/" + "asscoaitaion_table.txt", rowheader=X_labels, aSampleNames=Y_labels, corner = "#")
@@ -842,37 +876,42 @@ def run():
     
     #plot.heatmap2(dataset1=config.parsed_dataset[0], dataset2=config.parsed_dataset[1], xlabels =config.FeatureNames[0], ylabels = config.FeatureNames[1], filename = str(config.output_dir)+'/heatmap2_all' )
     if config.log_input:
-        logger.write_table(data=config.parsed_dataset[0], name=config.output_dir+"/X_dataset.txt", rowheader=config.FeatureNames[0] , colheader=config.SampleNames[0], prefix = "label",  corner = '#', delimiter= '\t')
-        logger.write_table(data=config.parsed_dataset[1], name=config.output_dir+"/Y_dataset.txt", rowheader=config.FeatureNames[1] , colheader=config.SampleNames[1], prefix = "label",  corner = '#', delimiter= '\t')
-    if config.descending == "AllA":
-        print("--- association hypotheses testing is started, this task may take longer ...")
-        start_time = time.time()
-        _naive_all_against_all()
-        excution_time_temp = time.time() - start_time
-        csvw.writerow(["Hypotheses testing time", str(datetime.timedelta(seconds=excution_time_temp)) ])
-        print("--- %s h:m:s hypotheses testing time ---" % str(datetime.timedelta(seconds=excution_time_temp)))
-    elif config.descending == "HAllA":
-        # hierarchical clustering 
-        start_time = time.time()
-        _hclust()
-        excution_time_temp = time.time() - start_time
-        csvw.writerow(["Hierarchical clustering time", str(datetime.timedelta(seconds=excution_time_temp)) ])
-        print("--- %s h:m:s hierarchical clustering time ---" % str(datetime.timedelta(seconds=excution_time_temp)))
+        strSuffix = ".gz" if config.gzip_tables else ""
+        logger.write_table(data=config.parsed_dataset[0], name=config.output_dir+"/X_dataset.txt"+strSuffix, rowheader=config.FeatureNames[0] , colheader=config.SampleNames[0], prefix = "label",  corner = '#', delimiter= '\t', fmt = config.table_format)
+        logger.write_table(data=config.parsed_dataset[1], name=config.output_dir+"/Y_dataset.txt"+strSuffix, rowheader=config.FeatureNames[1] , colheader=config.SampleNames[1], prefix = "label",  corner = '#', delimiter= '\t', fmt = config.table_format)
+    # the worker pool must not outlive a failed run
+    try:
+        if config.descending == "AllA":
+            print("--- association hypotheses testing is started, this task may take longer ...")
+            start_time = time.time()
+            _naive_all_against_all()
+            excution_time_temp = time.time() - start_time
+            csvw.writerow(["Hypotheses testing time", str(datetime.timedelta(seconds=excution_time_temp)) ])
+            print("--- %s h:m:s hypotheses testing time ---" % str(datetime.timedelta(seconds=excution_time_temp)))
+        elif config.descending == "HAllA":
+            # hierarchical clustering 
+            start_time = time.time()
+            _hclust()
+            excution_time_temp = time.time() - start_time
+            csvw.writerow(["Hierarchical clustering time", str(datetime.timedelta(seconds=excution_time_temp)) ])
+            print("--- %s h:m:s hierarchical clustering time ---" % str(datetime.timedelta(seconds=excution_time_temp)))
         
-        # coupling clusters hierarchically 
-        start_time = time.time()
-        _couple()
-        excution_time_temp = time.time() - start_time
-        csvw.writerow(["Coupling hypotheses tree time", str(datetime.timedelta(seconds=excution_time_temp)) ])
-        print("--- %s h:m:s coupling hypotheses tree time ---" % str(datetime.timedelta(seconds=excution_time_temp)))
-        # hypotheses testing
-        print("--- association hypotheses testing is started, this task may take longer ...")
-        start_time = time.time()
-        _hypotheses_testing()
-        excution_time_temp = time.time() - start_time
-        csvw.writerow(["number of performed permutation tests: ", config.number_of_performed_tests])
-        csvw.writerow(["Hypotheses testing time", str(datetime.timedelta(seconds=excution_time_temp)) ])
-        print("--- %s h:m:s hypotheses testing time ---" % str(datetime.timedelta(seconds=excution_time_temp)))
+            # coupling clusters hierarchically 
+            start_time = time.time()
+            _couple()
+            excution_time_temp = time.time() - start_time
+            csvw.writerow(["Coupling hypotheses tree time", str(datetime.timedelta(seconds=excution_time_temp)) ])
+            print("--- %s h:m:s coupling hypotheses tree time ---" % str(datetime.timedelta(seconds=excution_time_temp)))
+            # hypotheses testing
+            print("--- association hypotheses testing is started, this task may take longer ...")
+            start_time = time.time()
+            _hypotheses_testing()
+            excution_time_temp = time.time() - start_time
+            csvw.writerow(["number of performed permutation tests: ", config.number_of_performed_tests])
+            csvw.writerow(["Hypotheses testing time", str(datetime.timedelta(seconds=excution_time_temp)) ])
+            print("--- %s h:m:s hypotheses testing time ---" % str(datetime.timedelta(seconds=excution_time_temp)))
+    finally:
+        hierarchy.close_pool()
     
     # Generate a report
     start_time = time.time() 
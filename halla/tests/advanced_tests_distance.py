@@ -6,10 +6,16 @@ from halla import distance
 from halla import stats
 
 try:
+    import numpy
     from numpy import array
 except ImportError:
     sys.exit("Please install numpy")
 
+try:
+    import scipy.stats
+except ImportError:
+    sys.exit("Please install scipy")
+
 
 class TestHAllADistanceFunctions(unittest.TestCase):
     """
@@ -79,3 +85,112 @@ class TestHAllADistanceFunctions(unittest.TestCase):
             self.assertAlmostEqual(expected_result[i], distance.nmi(dx[i],dy[j]))        
 
         
+
+    def test_permuted_metrics(self):
+        """
+        Test the batched permutation scores against the single-call metrics
+        """
+        
+        numpy.random.seed(0)
+        x = numpy.random.randint(0, 4, 40)
+        y = (x + numpy.random.randint(0, 2, 40)) % 4
+        xf = numpy.random.randn(40)
+        yf = xf + numpy.random.randn(40)
+        aiPerm = array([numpy.random.permutation(40) for i in range(20)])
+        
+        for strMetric in distance.c_hash_metric_permuted:
+            (a, b) = (x, y) if strMetric in ["nmi", "mi", "ami"] else (xf, yf)
+            expected_result = [distance.c_hash_metric[strMetric](a, b[aiPermRow]) for aiPermRow in aiPerm]
+            result = distance.c_hash_metric_permuted[strMetric](a, b, aiPerm)
+            self.assertEqual(list(result), expected_result)
+
+    def test_level_metrics(self):
+        """
+        Test the stacked level scores against the batched permutation scores
+        """
+
+        numpy.random.seed(0)
+        X = numpy.random.randint(0, 4, (12, 30))
+        Y = numpy.random.randint(0, 6, (12, 30))
+        Y[3] = 2
+        Xf = numpy.random.randn(12, 30)
+        Yf = Xf + numpy.random.randn(12, 30)
+        aiPerm = array([numpy.random.permutation(30) for i in range(25)])
+
+        for strMetric in distance.c_hash_metric_level:
+            (A, B) = (X, Y) if strMetric in ["nmi", "mi"] else (Xf, Yf)
+            expected_result = [list(distance.c_hash_metric_permuted[strMetric](A[h], B[h], aiPerm)) for h in range(12)]
+            result = distance.c_hash_metric_level[strMetric](A, B, aiPerm)
+            self.assertEqual(result.tolist(), expected_result)
+
+    def test_nmi_kernel(self):
+        """
+        Test the contingency-table nmi kernel against scikit-learn
+        """
+        
+        from sklearn.metrics import normalized_mutual_info_score
+        numpy.random.seed(0)
+        for i in range(50):
+            x = numpy.random.randint(0, 5, 30)
+            y = (x + numpy.random.randint(0, 3, 30)) % 5
+            self.assertEqual(distance.nmi(x, y), normalized_mutual_info_score(x, y))
+            self.assertEqual(distance.nmi(x.astype(str), y - 2), normalized_mutual_info_score(x.astype(str), y - 2))
+        self.assertEqual(distance.nmi([1, 1, 1], [0, 0, 0]), 1.0)
+
+    def test_metric_matrix(self):
+        """
+        Test the all-pairs association matrices against the pairwise metrics
+        """
+        
+        numpy.random.seed(0)
+        x = numpy.random.randint(0, 4, (12, 30))
+        x[6:] = (x[:6] + numpy.random.randint(0, 2, (6, 30))) % 4
+        x[3] = 1
+        for strMetric in distance.c_hash_metric_matrix:
+            result = distance.c_hash_metric_matrix[strMetric](x)
+            for (i,j) in itertools.combinations(range(len(x)), 2):
+                self.assertEqual(result[i][j], distance.c_hash_metric[strMetric](x[i], x[j]))
+                self.assertEqual(result[j][i], result[i][j])
+
+    def test_sparse_kernels(self):
+        """
+        Test the background-level (sparse) kernels against the dense ones
+        """
+
+        from halla import config
+        numpy.random.seed(0)
+        X = numpy.random.randint(1, 4, (12, 30)) * (numpy.random.rand(12, 30) < 0.3)
+        Y = numpy.random.randint(1, 5, (12, 30)) * (numpy.random.rand(12, 30) < 0.4)
+        X[2] = 0
+        Y[5] = 3
+        Y[7] = numpy.random.randint(0, 3, 30)
+        aiPerm = array([numpy.random.permutation(30) for i in range(25)])
+        bSparse = config.sparse
+        try:
+            for strMetric in ["nmi", "mi"]:
+                expected_result = []
+                for config.sparse in [False, True]:
+                    expected_result.append((
+                        [list(distance.c_hash_metric_permuted[strMetric](X[h], Y[h], aiPerm)) for h in range(12)],
+                        distance.c_hash_metric_level[strMetric](X, Y, aiPerm).tolist(),
+                        distance.c_hash_metric_matrix[strMetric](numpy.vstack([X, Y])).tolist(),
+                        distance.c_hash_metric_cross[strMetric](X, Y).tolist()))
+                self.assertEqual(expected_result[1], expected_result[0])
+            # continuous zero-inflated rows, some negative, for the correlations
+            Xf = numpy.random.gamma(1.0, 1.0, (12, 30)) * (numpy.random.rand(12, 30) < 0.3)
+            Yf = Xf[::-1] + numpy.random.rand(12, 30) * (numpy.random.rand(12, 30) < 0.3)
+            Xf[3] -= 0.5 * (Xf[3] > 0)
+            Xf[4, :20] = 0.0
+            for x in Xf:
+                self.assertEqual(list(distance._sparse_rankdata(x)), list(scipy.stats.rankdata(x)))
+            for strMetric in ["pearson", "spearman"]:
+                expected_result = []
+                for config.sparse in [False, True]:
+                    expected_result.append(numpy.concatenate([
+                        array([distance.c_hash_metric_permuted[strMetric](Xf[h], Yf[h], aiPerm) for h in range(12)]).ravel(),
+                        distance.c_hash_metric_level[strMetric](Xf, Yf, aiPerm).ravel(),
+                        distance.c_hash_metric_cross[strMetric](Xf, Yf).ravel()]))
+                for fExpected, fResult in zip(expected_result[0], expected_result[1]):
+                    self.assertAlmostEqual(fExpected, fResult, places=12)
+        finally:
+            config.sparse = bSparse
@@ -0,0 +1,85 @@
+import inspect
+import re
+import sys
+import unittest
+
+from halla import distance
+from halla import hierarchy
+from halla import stats
+from halla import config
+
+try:
+    import numpy
+except ImportError:
+    sys.exit("Please install numpy")
+
+class TestHAllAHierarchyFunctions(unittest.TestCase):
+    """
+    Test the functions found in halla.hierarchy
+    """
+
+    def setUp(self):
+        self.saved = [config.parsed_dataset, config.discretized_dataset, config.FeatureNames,
+            config.similarity_method, config.iterations, config.q, config.alla_screen]
+
+    def tearDown(self):
+        (config.parsed_dataset, config.discretized_dataset, config.FeatureNames,
+            config.similarity_method, config.iterations, config.q, config.alla_screen) = self.saved
+
+    def test_all_against_all_screen(self):
+        """
+        Test that the analytic screen does not change the associations AllA reports
+        """
+
+        numpy.random.seed(0)
+        config.similarity_method = "nmi"
+        config.iterations = 200
+        config.q = 0.1
+        for n in [12, 60]:
+            X = numpy.random.randint(0, 3, (4, n))
+            Y = numpy.vstack([X[:2], numpy.random.randint(0, 2, (2, n))])
+            Y[0, :n / 4] = numpy.random.randint(0, 3, n / 4)
+            config.parsed_dataset = config.discretized_dataset = [X, Y]
+            config.FeatureNames = [["X%d" % i for i in range(4)], ["Y%d" % i for i in range(4)]]
+            expected_result = []
+            for fScreen in [0.0, 0.5]:
+                config.alla_screen = fScreen
+                aFinal, aOut = hierarchy.naive_all_against_all()
+                expected_result.append([test.m_pData for test in aFinal])
+            self.assertEqual(expected_result[0], expected_result[1])
+            # twelve samples are too few for the chi-square approximation
+            aP = stats.analytic_pvalues(X, Y)[0]
+            self.assertEqual((aP == 0).all(), n == 12)
+
+    def test_hypothesis_tree_children(self):
+        """
+        Test that tree rows expose their children but refuse list mutation
+        """
+
+        pTree = hierarchy.Hypothesis_Tree(iCapacity=2)
+        iRoot = pTree.add(pTree.add_cluster(0, [0, 1]), pTree.add_cluster(1, [0, 1]))
+        for i in range(2):
+            pTree.add(pTree.add_cluster(0, [i]), pTree.add_cluster(1, [i]), level_number=2)
+        pTree.set_children(iRoot, 1, 3)
+        pRoot = pTree.node(iRoot)
+        self.assertEqual([pChild.m_pData for pChild in hierarchy.get_children(pRoot)], [[[0], [0]], [[1], [1]]])
+        self.assertRaises(TypeError, hierarchy.pop, pRoot)
+        self.assertRaises(TypeError, hierarchy.add_child, pRoot, [[2], [2]])
+        self.assertRaises(TypeError, hierarchy.add_children, pRoot, [[[2], [2]]])
+        self.assertFalse(hasattr(pRoot.m_arrayChildren, "append"))
+        self.assertEqual(len(pRoot.m_arrayChildren), 2)
+        pNode = hierarchy.add_child(hierarchy.Hypothesis_Node([[0], [0]]), [[1], [1]])
+        self.assertEqual(hierarchy.pop(pNode).m_pData, [[1], [1]])
+
+    def test_worker_config(self):
+        """
+        Test that pool workers receive every run setting the kernels read
+        """
+
+        # state each process builds for itself rather than a run setting
+        astrState = ["random_state", "nullsamples", "gp", "Nexc", "null_cache", "medoid_cache",
+                     "representative_cache", "parsed_dataset"]
+        for pModule in [stats, distance]:
+            for strName in set(re.findall(r"config\.([A-Za-z_]+)", inspect.getsource(pModule))):
+                if strName not in astrState:
+                    self.assertIn(strName, hierarchy.c_astrWorkerConfig)
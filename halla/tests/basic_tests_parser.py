@@ -0,0 +1,148 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from halla import parser
+from halla import config
+
+try:
+    import numpy
+    from numpy import array
+except ImportError:
+    sys.exit("Please install numpy")
+
+class TestHAllAParserFunctions(unittest.TestCase):
+    """
+    Test the functions found in halla.parser
+    """
+
+    def setUp(self):
+        self.strDir = tempfile.mkdtemp()
+        self.saved = [config.missing_char, config.missing_method, config.cache_dir, list(config.data_type), config.min_var]
+
+    def tearDown(self):
+        shutil.rmtree(self.strDir)
+        config.missing_char, config.missing_method, config.cache_dir, config.data_type[:], config.min_var = self.saved
+
+    def write_file(self, strName, astrLines):
+        strFile = os.path.join(self.strDir, strName)
+        with open(strFile, "w") as file_handle:
+            file_handle.write("\n".join(astrLines) + "\n")
+        return strFile
+
+    def assertSameRows(self, aRows1, aRows2):
+        self.assertEqual(len(aRows1), len(aRows2))
+        for aRow1, aRow2 in zip(aRows1, aRows2):
+            self.assertEqual(len(aRow1), len(aRow2))
+            for value1, value2 in zip(aRow1, aRow2):
+                if isinstance(value1, float) and isinstance(value2, float) and numpy.isnan(value1):
+                    self.assertTrue(numpy.isnan(value2))
+                else:
+                    self.assertEqual(value1, value2)
+                    self.assertEqual(isinstance(value1, float), isinstance(value2, float))
+
+    def test_load_table_mixed_rows(self):
+        """
+        Test the streaming loader against load and parse_table on mixed and malformed rows
+        """
+
+        strFile = self.write_file("mixed.txt", [
+            "#\tS1\tS2\tS3",
+            "trailing_text\t1\t2\t3abc",
+            "hexadecimal\t1\t2\t0x1f",
+            "decimals\t1.5\t-2\t3e-2",
+            "signs\t.5\t+1\t1.",
+            "lexical\ta\tb\tc",
+            "missing\t1\t\t3",
+            "quoted\t\"1\"\t2\t3",
+            "spaces\t 1\t2 \t3",
+            "special\tinf\t2\tnan",
+            "double_dot\t1..2\t2\t3",
+            "exponent_only\t1e\t2\t3",
+            "\"quoted name\"\t1\t2\t3"])
+        for strMissing in ["", "NA"]:
+            config.missing_char = strMissing
+            aOut, aNames, aTypes, aHeaders = parser.load_table(strFile, True, False)
+            aOutParsed, aNamesParsed, aTypesParsed, aHeadersParsed = parser.parse_table(parser.load(strFile), True, False)
+            self.assertEqual(aNames, aNamesParsed)
+            self.assertEqual(aTypes, aTypesParsed)
+            self.assertEqual(aHeaders, aHeadersParsed)
+            self.assertSameRows([list(aRow) for aRow in aOut], aOutParsed)
+        self.assertEqual(aTypes[:4], ["LEX", "LEX", "CON", "CON"])
+
+    def test_load_table_numeric_block(self):
+        """
+        Test that a plain numeric table comes back as one float64 matrix
+        """
+
+        strFile = self.write_file("numeric.txt", ["#\tS1\tS2\tS3", "f1\t1\t2\t3", "f2\t-0.5\t1e3\t.25"])
+        aOut, aNames, aTypes, aHeaders = parser.load_table(strFile, True, False, iChunk=1)
+        self.assertEqual(aOut.tolist(), [[1.0, 2.0, 3.0], [-0.5, 1000.0, 0.25]])
+        self.assertEqual(aTypes, ["CON", "CON"])
+        self.assertEqual(aHeaders, ["S1", "S2", "S3"])
+
+    def test_load_table_no_numeric_rows(self):
+        """
+        Test tables with only lexical rows or only a header
+        """
+
+        strLexical = self.write_file("lexical.txt", ["#\tS1\tS2", "f1\ta\tb"])
+        aOut, aNames, aTypes, aHeaders = parser.load_table(strLexical, True, False)
+        self.assertEqual((aOut, aNames, aTypes, aHeaders), ([["a", "b"]], ["f1"], ["LEX"], ["S1", "S2"]))
+        strHeader = self.write_file("header.txt", ["f\tS1\tS2"])
+        aOut, aNames, aTypes, aHeaders = parser.load_table(strHeader, True, True)
+        self.assertEqual((list(aOut), aNames, aTypes, aHeaders), ([], [], [], ["S1", "S2"]))
+
+    def write_datasets(self):
+        numpy.random.seed(0)
+        strX = self.write_file("X.txt", ["\t".join(["#"] + ["S%d" % i for i in range(20)])] +
+            ["\t".join(["x%d" % i] + ["%.3f" % v for v in numpy.random.rand(20)]) for i in range(3)] +
+            ["\t".join(["lex"] + ["ab"[v] for v in numpy.random.randint(0, 2, 20)])])
+        strY = self.write_file("Y.txt", ["\t".join(["#"] + ["S%d" % i for i in range(20)])] +
+            ["\t".join(["y%d" % i] + ["%.3f" % v for v in numpy.random.rand(20)]) for i in range(2)])
+        return strX, strY
+
+    def input_from_cache(self, strX, strY):
+        config.cache_dir = os.path.join(self.strDir, "cache_dir")
+        parser.Input(strX, strY)
+        self.assertEqual(len(os.listdir(config.cache_dir)), 1)
+        return parser.Input(strX, strY).get()
+
+    def test_cache_round_trip(self):
+        """
+        Test that the cached datasets come back with the same data, names and types
+        """
+
+        strX, strY = self.write_datasets()
+        aOut = parser.Input(strX, strY).get()
+        strCache = os.path.join(self.strDir, "cache")
+        parser.save_cache(strCache, aOut)
+        for aCached in [parser.load_cache(strCache), self.input_from_cache(strX, strY)]:
+            for (pDiscretized, pOriginal, aNames, aTypes, aHeaders), aExpected in zip(aCached, aOut):
+                self.assertEqual(numpy.asarray(pDiscretized).tolist(), numpy.asarray(aExpected[0]).tolist())
+                self.assertEqual(numpy.asarray(pOriginal).tolist(), numpy.asarray(aExpected[1]).tolist())
+                self.assertEqual(aNames, list(aExpected[2]))
+                self.assertEqual(aTypes, list(aExpected[3]))
+                self.assertEqual(aHeaders, aExpected[4])
+        self.assertEqual(aOut[0][3], ["CON", "CON", "CON", "LEX"])
+
+    def test_cache_key(self):
+        """
+        Test that the cache key follows the file contents and the parse options
+        """
+
+        strX, strY = self.write_datasets()
+        strKey = parser.cache_key(strX, strY, True, False)
+        self.assertEqual(parser.cache_key(strX, strY, True, False), strKey)
+        self.assertNotEqual(parser.cache_key(strX, strY, True, True), strKey)
+        config.missing_method = "mean"
+        self.assertNotEqual(parser.cache_key(strX, strY, True, False), strKey)
+        config.missing_method = self.saved[1]
+        config.min_var = 0.05
+        self.assertNotEqual(parser.cache_key(strX, strY, True, False), strKey)
+        config.min_var = self.saved[4]
+        with open(strY, "a") as file_handle:
+            file_handle.write("\t".join(["y2"] + ["0.5"] * 20) + "\n")
+        self.assertNotEqual(parser.cache_key(strX, strY, True, False), strKey)
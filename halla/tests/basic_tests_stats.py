@@ -2,12 +2,19 @@ import sys
 import unittest
 
 from halla import stats
+from halla import config
 
 try:
+    import numpy
     from numpy import array
 except ImportError:
     sys.exit("Please install numpy")
 
+try:
+    import scipy.stats
+except ImportError:
+    sys.exit("Please install scipy")
+
 class TestHAllAStatsFunctions(unittest.TestCase):
     """
     Test the functions found in halla.stats
@@ -280,3 +287,208 @@ class TestHAllAStatsFunctions(unittest.TestCase):
         result=stats.discretize(x, aiSkip = [1,3])
         self.assertEqual(expected_result.all(),result.all())
         
+        
+    def test_discretize_rows(self):
+        """
+        Test the matrix discretizer against the row by row path
+        """
+        
+        numpy.random.seed(0)
+        for n in [1, 2, 7, 30]:
+            x = numpy.random.randint(0, 6, (5, n)).astype(float)
+            x[1] = numpy.random.randn(n)
+            x[2][numpy.random.rand(n) < 0.3] = numpy.nan
+            for number_of_bins in [None, 0, 2, 4]:
+                expected_result = stats.discretize(list(x), number_of_bins=number_of_bins)
+                result = stats.discretize_rows(x, number_of_bins)
+                self.assertEqual(result.tolist(), expected_result.tolist())
+                self.assertEqual(result.dtype, expected_result.dtype)
+        
+    def test_entropy_rows(self):
+        """
+        Test the matrix entropy against get_enropy row by row
+        """
+        
+        numpy.random.seed(0)
+        x = numpy.random.randint(1, 5, (6, 20))
+        x[1] = numpy.random.randint(0, 3, 20)
+        x[2] = 1
+        x[3][::2] = 4
+        x[3][1::2] = 1
+        expected_result = [stats.get_enropy(line) for line in x]
+        result = stats.entropy_rows(x)
+        for i in range(len(x)):
+            if numpy.isnan(expected_result[i]):
+                self.assertTrue(numpy.isnan(result[i]))
+            else:
+                self.assertEqual(result[i], expected_result[i])
+        
+    def test_null_cache_entry_marginals(self):
+        """
+        Test that representatives with the same marginal histograms share a null
+        """
+        
+        config.use_null_cache = True
+        config.null_cache = {}
+        try:
+            x = array([0, 0, 1, 1, 1, 2, 2, 2, 2])
+            y = array([5, 5, 5, 5, 7, 7, 7, 8, 8])
+            entry = stats.null_cache_entry(x, y)
+            self.assertTrue(stats.null_cache_entry(x[::-1], 10 - y) is entry)
+            self.assertFalse(stats.null_cache_entry(x, array([0, 1, 0, 1, 0, 1, 0, 1, 0])) is entry)
+            samples = stats.cached_null_samples(entry, 20)
+            self.assertEqual(samples[:10], stats.cached_null_samples(entry, 10))
+        finally:
+            config.use_null_cache = False
+            config.null_cache = {}
+        
+    def test_medoid_from_distance_matrix(self):
+        """
+        Test that the medoid read from config.Distance matches the one from pdist
+        """
+        
+        from scipy.spatial.distance import pdist, squareform
+        from halla import distance
+        x = array([[0, 0, 1, 1, 2, 2], [0, 0, 1, 1, 2, 1], [0, 1, 1, 1, 2, 2],
+            [1, 0, 0, 2, 2, 1], [0, 0, 1, 2, 2, 2]])
+        aDistance = config.Distance
+        config.Distance = [squareform(pdist(x, metric=distance.pDistance)), None]
+        config.medoid_cache = [{}, {}]
+        try:
+            for aiFeatures in [[0, 1, 2], [4, 2, 0, 3], [3]]:
+                expected_result = stats.medoid(x[aiFeatures])
+                result = stats.medoid(x[aiFeatures], aiFeatures = aiFeatures, iDataset = 0)
+                self.assertEqual(list(expected_result), list(result))
+                self.assertTrue(tuple(aiFeatures) in config.medoid_cache[0])
+        finally:
+            config.Distance = aDistance
+            config.medoid_cache = [{}, {}]
+
+    def test_sequential_test_pvalue(self):
+        """
+        Test the Besag-Clifford stopping rule on precomputed null scores
+        """
+        
+        aSaved = (config.sequential_exceedances, config.FeatureNames, config.iterations)
+        config.sequential_exceedances = 3
+        config.FeatureNames = [["a"], ["b"]]
+        config.iterations = 1000
+        try:
+            # the third exceedance comes with the fifth null score: p = 3 / 5
+            entry = {"samples": [0.1, 0.9, 0.2, 0.8, 0.7] + [0.0] * 995}
+            self.assertEqual(stats.sequential_test_pvalue(0.5, None, None, pNull = entry), 0.6)
+            # no exceedances and one test: p is soon clearly below q
+            entry = {"samples": [0.1] * 1000}
+            fP = stats.sequential_test_pvalue(0.5, None, None, pNull = entry)
+            self.assertTrue(fP < config.q and fP > 1.0 / 1001)
+            # with 10^4 tests the threshold is out of reach: all iterations are used
+            config.FeatureNames = [range(100), range(100)]
+            self.assertEqual(stats.sequential_test_pvalue(0.5, None, None, pNull = entry), 1.0 / 1001)
+        finally:
+            config.sequential_exceedances, config.FeatureNames, config.iterations = aSaved
+
+    def test_gpd_negloglike_gradient(self):
+        """
+        Test the analytic gradient of the GPD likelihood against finite differences
+        """
+        
+        numpy.random.seed(0)
+        data = numpy.random.exponential(1.0, 50)
+        for parms in [(0.3, 0.1), (-0.2, 0.5), (0.0, 0.2)]:
+            (fValue, aGradient) = stats.gpd_negloglike(array(parms), data)
+            for i in range(2):
+                aStep = 1e-6 * numpy.eye(2)[i]
+                fNumeric = (stats.gpd_negloglike(array(parms) + aStep, data)[0] -
+                    stats.gpd_negloglike(array(parms) - aStep, data)[0]) / 2e-6
+                self.assertAlmostEqual(aGradient[i], fNumeric, places=4)
+
+    def test_null_samples(self):
+        """
+        Test that NullSamples counts exceedances like a scan of the scores
+        """
+        
+        numpy.random.seed(0)
+        scores = list(numpy.round(numpy.random.rand(30), 1))
+        null_samples = stats.NullSamples(scores[:10])
+        null_samples.add(scores[10:25])
+        null_samples.add(scores[25:])
+        self.assertEqual(list(null_samples.sorted()), sorted(scores))
+        for x in [-1.0, 0.0, 0.3, 0.5, 1.0]:
+            self.assertEqual(stats.num_exceedances(null_samples, x), len([v for v in scores if v > x]))
+            self.assertEqual(stats.num_exceedances(null_samples, x, bInclusive = True), len([v for v in scores if v >= x]))
+
+    def test_null_samples_nan(self):
+        """
+        Test that NaN null scores are never counted as exceedances
+        """
+
+        scores = [0.2, float("nan"), 0.7, 0.4, float("nan"), 0.9]
+        null_samples = stats.NullSamples(scores[:2])
+        null_samples.add(scores[2:])
+        self.assertEqual(len(null_samples), len(scores))
+        for x in [-1.0, 0.2, 0.5, 0.9, 1.0, float("nan")]:
+            self.assertEqual(stats.num_exceedances(null_samples, x), len([v for v in scores if v > x]))
+            self.assertEqual(stats.num_exceedances(null_samples, x, bInclusive = True), len([v for v in scores if v >= x]))
+            self.assertEqual(stats.num_exceedances(null_samples, x), stats.num_exceedances(scores, x))
+
+    def test_hypothesis_random_state(self):
+        """
+        Test that a hypothesis draws the same permutations whatever ran before it
+        """
+        
+        aRandom = config.random_state
+        try:
+            stats.set_hypothesis_random_state([[0, 1], [2]])
+            expected_result = list(config.random_state.permutation(10))
+            stats.set_hypothesis_random_state([[3], [4, 5]])
+            config.random_state.permutation(10)
+            numpy.random.permutation(10)
+            stats.set_hypothesis_random_state([numpy.array([0, 1]), [2]])
+            self.assertEqual(list(config.random_state.permutation(10)), expected_result)
+        finally:
+            config.random_state = aRandom
+
+    def test_representative_random_state(self):
+        """
+        Test that a failing decomposition leaves the random stream of the test in place
+        """
+        
+        def _fail(pArray):
+            raise ValueError("decomposition failed")
+        aSaved = config.random_state, config.decomposition, stats.c_hash_decomposition["pca"]
+        try:
+            config.decomposition = "pca"
+            stats.c_hash_decomposition["pca"] = _fail
+            pRandom = config.random_state = numpy.random.RandomState(0)
+            self.assertRaises(ValueError, stats.representative, numpy.random.rand(2, 10), 0, aiFeatures = [0, 1])
+            self.assertTrue(config.random_state is pRandom)
+        finally:
+            config.random_state, config.decomposition, stats.c_hash_decomposition["pca"] = aSaved
+
+    def test_analytic_pvalues(self):
+        """
+        Test the screening p-values against scipy's pearsonr and a G-test
+        """
+        
+        numpy.random.seed(0)
+        X = numpy.random.randn(3, 40)
+        Y = X[[0, 2]] + numpy.random.randn(2, 40)
+        strMetric = config.similarity_method
+        try:
+            config.similarity_method = "pearson"
+            aP, aSim = stats.analytic_pvalues(X, Y)
+            for i in range(3):
+                for j in range(2):
+                    (fR, fP) = scipy.stats.pearsonr(X[i], Y[j])
+                    self.assertAlmostEqual(aP[i, j], fP, places=10)
+            config.similarity_method = "mi"
+            X = numpy.random.randint(0, 3, (2, 60))
+            Y = numpy.random.randint(0, 2, (2, 60))
+            aP, aSim = stats.analytic_pvalues(X, Y)
+            for i in range(2):
+                for j in range(2):
+                    table = numpy.array([[numpy.sum((X[i] == a) & (Y[j] == b)) for b in range(2)] for a in range(3)])
+                    fP = scipy.stats.chi2_contingency(table, correction=False, lambda_="log-likelihood")[1]
+                    self.assertAlmostEqual(aP[i, j], fP, places=10)
+        finally:
+            config.similarity_method = strMetric